@@ -0,0 +1,196 @@
+#!./python
+
+import sys, os, getopt, shutil, subprocess, tempfile, time
+import numpy as np
+from common import *
+from frontend import make_profile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the synthetic corpus has training speakers tr*, test speakers te* and a few
+# consonants that extraction has to skip, like the real one
+LABELS = 'aeiouyptk'
+SOUNDS = '^[aeiouy]$'
+SIZES = [10000, 100000, 1000000]
+# below this some vowel may be missing from one of the sets
+MIN_SIZE = 5000
+
+def make_corpus(filename, frames, seed=1):
+    # groups of 20 to 80 frames, every fifth one a test group, with labels
+    # taking turns in both sets; every label has a mean spectrum of its own,
+    # every group a gain and every frame some noise
+    rng = np.random.RandomState(seed)
+    profile = make_profile(16000, fft=False)
+    means = profile.mel_power_threshold + rng.uniform(20., 60., (len(LABELS), profile.mel_filters))
+    packet = np.dtype([ ('id', np.uint8), ('mels', np.float32, (profile.mel_filters,)) ])
+
+    with open(filename, 'wb') as f:
+        writer = MFCCWriter(f)
+        writer.write(profile)
+        done = group = 0
+        while done < frames:
+            n = min(rng.randint(20, 81), frames - done)
+            label = group // 5 % len(LABELS)
+            writer.write(GroupHeaderPacket(
+                seq = 0,
+                profile = profile,
+                filename = '%s%d/f%d.ogg' % ('te' if 4 == group % 5 else 'tr', group % 20, group),
+                label = LABELS[label],
+                sample_offset = rng.randint(1 << 20)))
+            P = np.empty(n, dtype=packet)
+            P['id'] = FRAME_PACKET_ID
+            P['mels'] = means[label] + rng.uniform(-6., 6.) + rng.normal(0., 2., (n, profile.mel_filters))
+            f.write(P.tobytes())
+            done += n
+            group += 1
+
+def script(name, *args):
+    return [sys.executable, os.path.join(HERE, name)] + list(args)
+
+def chain(mode, corpus):
+    # what workflow.py runs for one mode: name, command and outputs
+    stages = []
+    for name, regexp in (('training', '^tr'), ('test', '^te')):
+        stages.append(('extract-%s' % name, script('extract-sounds.py', regexp, SOUNDS, corpus, '%s.mfcc' % name),
+                       ['%s.mfcc' % name]))
+    for name in ('training', 'test'):
+        selected = '%s-%s.mfcc' % (name, mode)
+        stages.append(('select-%s' % name, script('select-frames.py', parse_mode(mode)[0], '%s.mfcc' % name, selected),
+                       [selected]))
+        stages.append(('pre-nnet-%s' % name, script('pre-nnet.py', mode, '%s.pkl' % name, selected), ['%s.pkl' % name]))
+    stages.append(('learn', script('nnet.py', 'learn', 'training.pkl', 'weights.pkl'), ['weights.pkl']))
+    stages.append(('test', script('nnet.py', 'test', 'test.pkl', 'weights.pkl'), []))
+    return stages
+
+def run(name, command, cwd, outputs):
+    env = dict(os.environ)
+    env.setdefault('NNETS_SEED', '1')
+
+    log = os.path.join(cwd, name + '.log')
+    start = time.time()
+    with open(log, 'wb') as f:
+        p = subprocess.Popen(command, cwd=cwd, env=env, stdout=f, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(p.pid, 0)
+    wall = time.time() - start
+    if status:
+        with open(log) as f:
+            sys.stderr.write(f.read()[-4096:])
+        raise Exception('%s failed with status %d' % (name, status >> 8))
+
+    return dict(
+        time = wall,
+        cpu = usage.ru_utime + usage.ru_stime,
+        rss = usage.ru_maxrss * 1024,
+        output = sum( os.path.getsize(os.path.join(cwd, x)) for x in outputs ))
+
+def fit(frames, results, stage):
+    # time grows as the power of the corpus size seen between the two largest
+    # runs, where interpreter startup matters least; memory along a line
+    # through all of them
+    n1, n2 = frames[-2:]
+    t1, t2 = [ max(results[n][stage]['time'], 1e-3) for n in (n1, n2) ]
+    exponent = np.log(t2 / t1) / np.log(float(n2) / n1)
+    m = [ results[n][stage]['rss'] for n in frames ]
+    slope, base = np.polyfit(np.array(frames, dtype=np.float64), np.array(m, dtype=np.float64), 1)
+    return exponent, t2 / n2 ** exponent, slope, base
+
+def breaks_at(exponent, scale, slope, base, time_limit, memory_limit):
+    # the corpus size at which a stage first runs out of time or memory
+    with np.errstate(over='ignore'):
+        by_time = (time_limit / scale) ** (1. / exponent) if exponent > 0 else np.inf
+    if base >= memory_limit:
+        by_memory = 0.
+    elif slope > 0:
+        by_memory = (memory_limit - base) / slope
+    else:
+        by_memory = np.inf
+    if by_time <= by_memory:
+        return by_time, 'time'
+    return by_memory, 'memory'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'k',
+            ['sizes=', 'mode=', 'project=', 'time-limit=', 'memory-limit=', 'slack=', 'update'])
+    except getopt.GetoptError:
+        args = None
+    if args is None or len(args) > 1:
+        sys.stderr.write('USAGE: bench-pipeline.py [-k] [--sizes 10000,100000,...] [--mode pca] [--project frames]\n'
+                         '                         [--time-limit s] [--memory-limit MB] [--slack 1.25] [--update] [results json]\n')
+        sys.exit(1)
+    opts = dict(opts)
+
+    sizes = sorted(map(int, opts['--sizes'].split(','))) if '--sizes' in opts else SIZES
+    if sizes[0] < MIN_SIZE:
+        raise ValueError('corpora need at least %d frames' % MIN_SIZE)
+    mode = opts.get('--mode', 'pca')
+    project = int(opts.get('--project', 10 * sizes[-1]))
+    time_limit = float(opts.get('--time-limit', 3600.))
+    memory_limit = float(opts['--memory-limit']) * (1 << 20) if '--memory-limit' in opts else \
+                   float(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    slack = float(opts.get('--slack', 1.25))
+    results_file = args[0] if args else None
+
+    previous = load_baseline(results_file, mode = mode)
+
+    workdir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    results = dict()
+    regressed = []
+    try:
+        for frames in sizes:
+            corpus = os.path.join(workdir, 'corpus.mfcc')
+            make_corpus(corpus, frames)
+            print '%d frames, %.1f MB corpus' % (frames, os.path.getsize(corpus) / 1048576.)
+            print '  %-18s %9s %9s %9s %10s' % ('stage', 'wall s', 'cpu s', 'peak MB', 'output MB')
+
+            results[frames] = dict()
+            before = previous.get(str(frames), dict())
+            for name, command, outputs in chain(mode, corpus):
+                r = run(name, command, workdir, outputs)
+                results[frames][name] = r
+
+                note = ''
+                if name in before:
+                    b = before[name]
+                    note = '  (was %.2fs, %.1f MB)' % (b['time'], b['rss'] / 1048576.)
+                    # leave room for scheduling jitter and allocator noise
+                    if r['time'] > slack * b['time'] + .5 or r['rss'] > slack * b['rss'] + (16 << 20):
+                        regressed.append('%s at %d frames' % (name, frames))
+                        note += ' REGRESSED'
+                print '  %-18s %9.2f %9.2f %9.1f %10.2f%s' % (
+                    name, r['time'], r['cpu'], r['rss'] / 1048576., r['output'] / 1048576., note)
+
+            if '-k' not in opts:
+                for x in os.listdir(workdir):
+                    os.unlink(os.path.join(workdir, x))
+    finally:
+        if '-k' in opts:
+            print 'kept the files of the last run in %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+
+    if len(sizes) > 1:
+        print
+        print 'scaling, projected to %d frames (limits %.0fs, %.0f MB):' % (project, time_limit, memory_limit / 1048576.)
+        print '  %-18s %9s %10s %10s %10s  %s' % ('stage', 'time ~N^', 'wall s', 'MB/Mframe', 'peak MB', 'breaks at')
+        first = None
+        for name, _, _ in chain(mode, ''):
+            exponent, scale, slope, base = fit(sizes, results, name)
+            limit, reason = breaks_at(exponent, scale, slope, base, time_limit, memory_limit)
+            if first is None or limit < first[0]:
+                first = (limit, reason, name)
+            print '  %-18s %9.2f %10.1f %10.1f %10.1f  %s' % (
+                name, exponent, scale * project ** exponent, slope * 1e6 / 1048576., (base + slope * project) / 1048576.,
+                '%.3g frames (%s)' % (limit, reason) if np.isfinite(limit) else '-')
+        if np.isfinite(first[0]):
+            print '%s breaks first, running out of %s at about %.3g frames' % (first[2], first[1], first[0])
+
+    if results_file:
+        save_baseline(results_file, previous, dict( (str(n), r) for n, r in results.iteritems() ),
+                      regressed, '--update' in opts, mode = mode)
+    if regressed:
+        sys.stderr.write('pipeline regressed for: %s\n' % ', '.join(regressed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!./python
+
+import sys, os, time, subprocess, resource
+import cStringIO
+import numpy as np
+from common import *
+from shmring import ShmWriter, ShmReader, slot_size_for, ring_path, wake_dir
+from frontend import make_profile
+
+RING = 'bench-shm-%d' % os.getpid()
+
+# the send time rides in the first two fft powers: whole seconds (mod 1e5,
+# exact in a float32) and the fraction
+def stamp(x):
+    t = time.time()
+    x[0] = t % 100000 // 1
+    x[1] = t % 1
+def sent_at(fft_powers, now):
+    t = float(fft_powers[0]) + float(fft_powers[1])
+    return t + (now - now % 100000)
+
+def produce(transport, ring, frames, rate):
+    profile = make_profile(16000)
+    header = GroupHeaderPacket(seq = 1, profile = profile, filename = 'bench', label = '?', sample_offset = 0)
+    x = np.zeros(profile.mel_filters + profile.fft_length, dtype=np.float32)
+
+    if 'pipe' == transport:
+        writer = MFCCWriter(sys.stdout)
+        writer.write(profile)
+        writer.write(header)
+        def send():
+            writer.write(FramePacket(seq = 0, group_header = header, sample_offset = 0,
+                                     mel_powers = x[:profile.mel_filters], fft_powers = x[profile.mel_filters:]))
+            sys.stdout.flush()
+    else:
+        writer = ShmWriter(ring, slot_size_for(profile.mel_filters, profile.fft_length))
+        for packet in (profile, header):
+            buf = cStringIO.StringIO()
+            MFCCWriter(buf).write(packet)
+            writer.write_raw(buf.getvalue())
+        def send():
+            writer.write_frame(x)
+
+    # give the consumer time to attach
+    time.sleep(.2)
+    start = time.time()
+    for i in xrange(frames):
+        delay = start + float(i) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        stamp(x[profile.mel_filters:])
+        send()
+
+    if 'shm' == transport:
+        writer.finish()
+
+def consume(transport, frames, rate):
+    ring = '%s-%s' % (RING, transport)
+    producer = subprocess.Popen([sys.executable, __file__, 'produce', transport, ring, str(frames), str(rate)],
+                                stdout=subprocess.PIPE)
+    if 'pipe' == transport:
+        reader = MFCCReader(producer.stdout)
+    else:
+        reader = ShmReader(ring, from_start=True)
+
+    latencies = []
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    for packet in reader:
+        if isinstance(packet, FramePacket):
+            now = time.time()
+            latencies.append(now - sent_at(packet.fft_powers, now))
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    _, _, usage = os.wait4(producer.pid, 0)
+    if 'shm' == transport:
+        reader.close()
+        os.unlink(ring_path(ring))
+        os.rmdir(wake_dir(ring))
+
+    latencies = np.array(latencies) * 1e6
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return dict(
+        frames = len(latencies),
+        median = np.median(latencies),
+        p99 = np.percentile(latencies, 99),
+        consumer = 1e6 * cpu / max(len(latencies), 1),
+        producer = 1e6 * (usage.ru_utime + usage.ru_stime) / max(len(latencies), 1))
+
+def main():
+    if len(sys.argv) == 6 and 'produce' == sys.argv[1]:
+        return produce(sys.argv[2], sys.argv[3], int(sys.argv[4]), float(sys.argv[5]))
+
+    if len(sys.argv) not in (1,2,3):
+        sys.stderr.write('USAGE: bench-shm.py [frames=4000] [frames per second=2000]\n')
+        sys.exit(1)
+
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 2000.
+
+    print '%d frames at %.0f frames/s' % (frames, rate)
+    print '%-6s %8s %12s %12s %14s %14s' % ('', 'frames', 'median us', 'p99 us', 'consumer us/f', 'producer us/f')
+    for transport in ('pipe', 'shm'):
+        r = consume(transport, frames, rate)
+        print '%-6s %8d %12.1f %12.1f %14.1f %14.1f' % (
+            transport, r['frames'], r['median'], r['p99'], r['consumer'], r['producer'])
+
+if __name__ == '__main__':
+    main()
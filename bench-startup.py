@@ -0,0 +1,81 @@
+#!./python
+
+import sys, os, getopt, glob, subprocess, time
+from common import load_baseline, save_baseline
+
+PROBE = '''
+import sys, time, imp
+start = time.time()
+imp.load_source('__bench__', sys.argv[1])
+print time.time() - start, int('numpy' in sys.modules), int('scipy' in sys.modules)
+'''
+
+def measure(script, runs):
+    walls = []
+    imports = []
+    for i in xrange(runs):
+        start = time.time()
+        p = subprocess.Popen([sys.executable, '-c', PROBE, script],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        walls.append(time.time() - start)
+        if 0 != p.returncode:
+            return None
+        t, has_numpy, has_scipy = out.split()
+        imports.append(float(t))
+    walls.sort()
+    imports.sort()
+    return dict(wall = walls[runs//2], imports = imports[runs//2],
+                numpy = bool(int(has_numpy)), scipy = bool(int(has_scipy)))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '', ['update'])
+    except getopt.GetoptError:
+        args = None
+    if args is None or len(args) > 2:
+        sys.stderr.write('USAGE: bench-startup.py [--update] [runs] [results json]\n')
+        sys.exit(1)
+    opts = dict(opts)
+
+    runs = int(args[0]) if len(args) > 0 else 10
+    results_file = args[1] if len(args) > 1 else None
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    scripts = sorted( x for x in glob.glob(os.path.join(here, '*.py'))
+                      if os.path.basename(x) not in ('common.py', 'wavelet.py', 'bench-startup.py') )
+
+    previous = load_baseline(results_file)
+
+    empty = measure(os.devnull, runs)
+    print 'interpreter alone: %.1f ms' % (1000. * empty['wall'])
+    print '%-20s %9s %9s  %s' % ('script', 'wall ms', 'import ms', 'loads')
+
+    results = dict()
+    regressed = []
+    for script in scripts:
+        name = os.path.basename(script)
+        r = measure(script, runs)
+        if r is None:
+            print '%-20s %9s' % (name, 'failed')
+            continue
+        results[name] = r
+
+        loads = ' '.join( x for x in ('numpy', 'scipy') if r[x] )
+        note = ''
+        if name in previous:
+            before = previous[name]['imports']
+            note = '  (was %.1f ms)' % (1000. * before)
+            if r['imports'] > 1.25 * before + .005:
+                regressed.append(name)
+                note += ' REGRESSED'
+        print '%-20s %9.1f %9.1f  %s%s' % (name, 1000. * r['wall'], 1000. * r['imports'], loads or '-', note)
+
+    if results_file:
+        save_baseline(results_file, previous, results, regressed, '--update' in opts)
+    if regressed:
+        sys.stderr.write('startup regressed for: %s\n' % ' '.join(regressed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,28 @@
 #!./python
 
-import sys, itertools, collections, struct
-import numpy as np
-try:
-    import scipy.fftpack
-except ImportError:
-    pass # maybe we won't need it...
-import wavelet
+import sys, os, itertools, collections, struct, bisect, threading, Queue, importlib, json
+
+class LazyModule(object):
+    # stands in for a module until its first use, so tools that never
+    # compute features don't pay for importing numpy and scipy
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__dict__['_lazy_name'])
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+np = LazyModule('numpy')
+fftpack = LazyModule('scipy.fftpack')
+wavelet = LazyModule('wavelet')
+
+# features, weights and posteriors are computed in DTYPE; NNETS_DTYPE=float64
+# opts into double precision. Everything downstream follows the dtype of its
+# inputs, so only the places that make arrays need to look at it
+DTYPE = os.environ.get('NNETS_DTYPE', 'float32')
+if DTYPE not in ('float32', 'float64'):
+    raise ValueError('NNETS_DTYPE must be float32 or float64, not %s' % DTYPE)
 
 ProfilePacket = collections.namedtuple('ProfilePacket', 
     ('seq',
@@ -22,8 +38,13 @@ GROUP_HEADER_PACKET_ID = 2
 FRAME_PACKET_ID = 3
 
 class MFCCReader(object):
-    def __init__(self, f):
-        self._f = f
+    # parses from large blocks instead of reading packet by packet; pipes are
+    # read with os.read so a live stream is never held back waiting for a
+    # full block. f may also be a list of files, read back to back, and
+    # readahead > 0 moves reading to a thread queueing that many blocks
+    def __init__(self, f, readahead=0, block_size=1<<18):
+        self._files = list(f) if isinstance(f, (list, tuple)) else [f]
+        self._block_size = block_size
         self.current_profile = None
         self.current_group_header = None
 
@@ -31,32 +52,157 @@ class MFCCReader(object):
         self._group_header_seq = 0
         self._frame_seq = 0
         self._sample_offset = None
-
+        self._frame_struct = None
+
+        self._raw = []
+        for x in self._files:
+            try:
+                x.seek(0, 1)
+                self._raw.append(False)
+            except (IOError, AttributeError):
+                self._raw.append(hasattr(x, 'fileno'))
+
+        self.seekable = 1 == len(self._files) and not self._raw[0] and not readahead
+        self._file_index = 0
+        self._buf = ''
+        self._pos = 0
+        self._base = self._files[0].tell() if self.seekable else 0
+        self._eof = False
+
+        self._queue = None
+        if readahead:
+            self._queue = Queue.Queue(readahead)
+            t = threading.Thread(target=self._read_ahead)
+            t.daemon = True
+            t.start()
+
+    def _read_block(self):
+        while self._file_index < len(self._files):
+            f = self._files[self._file_index]
+            if self._raw[self._file_index]:
+                block = os.read(f.fileno(), self._block_size)
+            else:
+                block = f.read(self._block_size)
+            if block:
+                return block
+            self._file_index += 1
+        return ''
+
+    def _read_ahead(self):
         try:
-            self._f.seek(0, 1)
-            self.seekable = True
-        except IOError:
-            self.seekable = False
-
-    def _read_fmt(self, fmt):
-        size = struct.calcsize(fmt)
-        return struct.unpack(fmt, self._f.read(size))
+            while True:
+                block = self._read_block()
+                self._queue.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._queue.put(e)
+
+    def _more(self):
+        if self._eof:
+            return False
+        if self._queue is None:
+            block = self._read_block()
+        else:
+            block = self._queue.get()
+            if isinstance(block, Exception):
+                raise block
+        if not block:
+            self._eof = True
+            return False
+        self._base += self._pos
+        self._buf = self._buf[self._pos:] + block
+        self._pos = 0
+        return True
+
+    def _need(self, size):
+        while len(self._buf) - self._pos < size:
+            if not self._more():
+                raise Exception('truncated packet at offset %d' % self.tell())
+
+    def _unpack(self, fmt):
+        fmt = fmt if isinstance(fmt, struct.Struct) else struct.Struct(fmt)
+        self._need(fmt.size)
+        x = fmt.unpack_from(self._buf, self._pos)
+        self._pos += fmt.size
+        return x
 
     def __iter__(self):
         return self
 
+    def buffered(self):
+        return len(self._buf) - self._pos
+
+    def fill(self):
+        # one more block, which won't block on a descriptor that polled readable
+        return self._more()
+
+    def frame_buffered(self):
+        # whether the buffer holds a whole frame packet, after any profiles
+        # and group headers before it, so next() can get there without reading
+        buf, pos = self._buf, self._pos
+        profile = self.current_profile
+        frame_size = None if profile is None else frame_packet_size(profile)
+        while pos < len(buf):
+            packet_id = ord(buf[pos])
+            if PROFILE_PACKET_ID == packet_id:
+                size = struct.calcsize(PROFILE_HEADER_FMT)
+                if pos + size > len(buf):
+                    return False
+                _, mel_filters, fft_length = struct.unpack_from(PROFILE_HEADER_FMT, buf, pos)[:3]
+                frame_size = 1 + 4 * (mel_filters + fft_length)
+                pos += size + 4 * (mel_filters+2 + fft_length)
+            elif GROUP_HEADER_PACKET_ID == packet_id:
+                size = struct.calcsize(GROUP_HEADER_FMT)
+                if pos + size > len(buf):
+                    return False
+                _, filename_len, label_len, _ = struct.unpack_from(GROUP_HEADER_FMT, buf, pos)
+                pos += size + filename_len + label_len
+            elif FRAME_PACKET_ID == packet_id and frame_size is not None:
+                return pos + frame_size <= len(buf)
+            else:
+                # let next() complain
+                return True
+        return False
+
+    def tell(self):
+        return self._base + self._pos
+
+    def checkpoint(self):
+        return (self.tell(), self.current_profile, self.current_group_header,
+                self._profile_seq, self._group_header_seq, self._frame_seq, self._sample_offset)
+
+    def restore(self, checkpoint):
+        offset, self.current_profile, self.current_group_header, \
+        self._profile_seq, self._group_header_seq, self._frame_seq, self._sample_offset = checkpoint
+        if self.current_profile is not None:
+            self._frame_struct = self._make_frame_struct(self.current_profile)
+
+        if self._base <= offset <= self._base + len(self._buf):
+            self._pos = offset - self._base
+            return
+        self._files[0].seek(offset)
+        self._file_index = 0
+        self._buf = ''
+        self._pos = 0
+        self._base = offset
+        self._eof = False
+
+    def _make_frame_struct(self, profile):
+        return struct.Struct('=%df' % (profile.mel_filters + profile.fft_length))
+
     def next(self):
-        packet_id = self._f.read(1)
-        if len(packet_id) < 1:
+        if self._pos >= len(self._buf) and not self._more():
             raise StopIteration
-        (packet_id,) = struct.unpack('=b', packet_id)
+        (packet_id,) = struct.unpack_from('=b', self._buf, self._pos)
+        self._pos += 1
 
         if PROFILE_PACKET_ID == packet_id:
             mel_filters, fft_length, \
             frame_length, frame_spacing, sample_rate, \
-            mel_power_threshold = self._read_fmt('=bHHHHf')
+            mel_power_threshold = self._unpack('=bHHHHf')
 
-            x = self._read_fmt('=%df' % (mel_filters+2 + fft_length))
+            x = self._unpack('=%df' % (mel_filters+2 + fft_length))
 
             self._profile_seq += 1
             self.current_profile = ProfilePacket(
@@ -70,11 +216,12 @@ class MFCCReader(object):
                 mel_freqs = x[:mel_filters+2],
                 fft_freqs = x[mel_filters+2:]
             )
+            self._frame_struct = self._make_frame_struct(self.current_profile)
             return self.current_profile
 
         if GROUP_HEADER_PACKET_ID == packet_id:
-            filename_len, label_len, sample_offset = self._read_fmt('=bbi')
-            filename, label = self._read_fmt('=%ds%ds' % (filename_len, label_len))
+            filename_len, label_len, sample_offset = self._unpack('=bbi')
+            filename, label = self._unpack('=%ds%ds' % (filename_len, label_len))
 
             self._sample_offset = sample_offset
             self._group_header_seq += 1
@@ -89,10 +236,9 @@ class MFCCReader(object):
 
         if FRAME_PACKET_ID == packet_id:
             profile = self.current_profile
-            x = self._read_fmt('=%df' % (profile.mel_filters + profile.fft_length))
-            x = iter(x)
-            mel_powers = list(itertools.islice(x, profile.mel_filters))
-            fft_powers = list(itertools.islice(x, profile.fft_length))
+            x = self._unpack(self._frame_struct)
+            mel_powers = list(x[:profile.mel_filters])
+            fft_powers = list(x[profile.mel_filters:])
 
             self._frame_seq += 1
             frame = FramePacket(
@@ -120,22 +266,97 @@ class MFCCReader(object):
                 frames.append(packet)
         return (profiles, group_headers, frames)
 
+def frame_packet_size(profile):
+    return 1 + 4 * (profile.mel_filters + profile.fft_length)
+
+# Seekable input is re-read on demand, keeping one checkpoint per run of
+# frames and a small LRU of decoded frames; a stream keeps only the last
+# `depth` frames in a ring buffer. Decoded frames hold Python floats, some
+# 7 KB of them with 200 fft powers, so the default of 4096 frames (41 s at
+# a 10 ms step) stays under 30 MB.
 class SeekableMFCCReader(object):
-    def __init__(self, reader):
+    def __init__(self, reader, depth=4096, cache=1024):
         self._reader = reader
-        self.history = []
         self.hindex = 0
         self.seekable = True
+        self.streaming = not reader.seekable
+
+        self._count = 0
+        if self.streaming:
+            self._ring = collections.deque(maxlen=depth)
+        else:
+            self._cache = collections.OrderedDict()
+            self._cache_size = cache
+            self._run_firsts = []
+            self._run_checkpoints = []
+            self._in_run = False
+            self._scan = reader.checkpoint()
 
     def __iter__(self):
         return self
 
-    def get_current_frame(self):
-        while self.hindex >= len(self.history):
-            packet = next(self._reader)
+    def _oldest(self):
+        return self._count - len(self._ring) if self.streaming else 0
+
+    def _remember(self, index, frame):
+        self._cache[index] = frame
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _read_next(self):
+        reader = self._reader
+        if self.streaming:
+            while True:
+                packet = next(reader)
+                if isinstance(packet, FramePacket):
+                    self._ring.append(packet)
+                    self._count += 1
+                    # a paused reader stays on the oldest frame still kept
+                    self.hindex = max(self.hindex, self._oldest())
+                    return packet
+
+        reader.restore(self._scan)
+        while True:
+            checkpoint = None if self._in_run else reader.checkpoint()
+            packet = next(reader)
             if isinstance(packet, FramePacket):
-                self.history.append(packet)
-        return self.history[self.hindex]
+                break
+            self._in_run = False
+
+        if checkpoint is not None:
+            self._run_firsts.append(self._count)
+            self._run_checkpoints.append(checkpoint)
+            self._in_run = True
+        self._scan = reader.checkpoint()
+        self._remember(self._count, packet)
+        self._count += 1
+        return packet
+
+    def _fetch(self, index):
+        if self.streaming:
+            return self._ring[index - self._oldest()]
+
+        if index in self._cache:
+            frame = self._cache.pop(index)
+            self._cache[index] = frame
+            return frame
+
+        r = bisect.bisect_right(self._run_firsts, index) - 1
+        offset, profile, group_header, profile_seq, group_header_seq, frame_seq, sample_offset = \
+            self._run_checkpoints[r]
+        k = index - self._run_firsts[r]
+        self._reader.restore((
+            offset + k * frame_packet_size(profile), profile, group_header,
+            profile_seq, group_header_seq, frame_seq + k, sample_offset + k * profile.frame_spacing))
+
+        frame = next(self._reader)
+        self._remember(index, frame)
+        return frame
+
+    def get_current_frame(self):
+        while self.hindex >= self._count:
+            self._read_next()
+        return self._fetch(self.hindex)
 
     def get_current_group_header(self):
         return self.get_current_frame().group_header
@@ -149,15 +370,68 @@ class SeekableMFCCReader(object):
         self.hindex += 1
         return self.get_current_frame()
 
+    def pull(self):
+        # for a watch on the descriptor: one read, then every frame complete
+        # in the buffer, since the watch won't fire again for those; a partial
+        # packet waits for the next event, as finishing it would block.
+        # None if no frame is complete yet
+        if not self._reader.frame_buffered() and not self._reader.fill():
+            raise StopIteration
+        frame = None
+        while self._reader.frame_buffered():
+            frame = self._read_next()
+        return frame
+
+    def seek_latest(self):
+        self.hindex = self._count - 1
+        return self.get_current_frame()
+
     def seek(self, offs):
-        self.hindex += offs
-        if self.hindex < 0:
-            self.hindex = 0
+        self.hindex = max(self.hindex, self._oldest())
+        self.hindex = max(self.hindex + offs, self._oldest())
+        if self.streaming:
+            self.hindex = min(self.hindex, self._count-1)
         try:
             return self.get_current_frame()
         except StopIteration:
-            self.hindex = len(self.history)-1
-            return self.history[self.hindex]
+            self.hindex = self._count-1
+            return self._fetch(self.hindex)
+
+    def seek_group(self, offs):
+        self.get_current_frame()
+        if self.streaming:
+            return self._seek_group_ring(offs)
+
+        r = bisect.bisect_right(self._run_firsts, self.hindex) - 1 + offs
+        try:
+            while r >= len(self._run_firsts):
+                self._read_next()
+        except StopIteration:
+            r = len(self._run_firsts) - 1
+        self.hindex = self._run_firsts[max(r, 0)]
+        return self.get_current_frame()
+
+    def _group_start(self, i):
+        group_header = self._fetch(i).group_header
+        while i > self._oldest() and self._fetch(i-1).group_header is group_header:
+            i -= 1
+        return i
+
+    def _seek_group_ring(self, offs):
+        last = self._count-1
+        for _ in xrange(abs(offs)):
+            if offs > 0:
+                group_header = self._fetch(self.hindex).group_header
+                i = self.hindex
+                while i < last and self._fetch(i).group_header is group_header:
+                    i += 1
+                if self._fetch(i).group_header is group_header:
+                    break
+                self.hindex = i
+            else:
+                i = self._group_start(self.hindex)
+                self.hindex = self._group_start(i-1) if i > self._oldest() else i
+        return self._fetch(self.hindex)
 
 class MFCCWriter(object):
     def __init__(self, f):
@@ -195,7 +469,7 @@ class MFCCWriter(object):
         ))
 
     def _write_frame(self, packet):
-        x = packet.mel_powers + packet.fft_powers
+        x = list(packet.mel_powers) + list(packet.fft_powers)
         self._f.write(struct.pack('=b%df' % len(x), FRAME_PACKET_ID, *x))
 
     def write(self, packet):
@@ -207,26 +481,82 @@ class MFCCWriter(object):
             return self._write_frame(packet)
         raise TypeError('unsupported packet type ' + type(packet))
 
+PROFILE_HEADER_FMT = '=bbHHHHf'
+GROUP_HEADER_FMT = '=bbbi'
+
+def raw_packets(f):
+    offset = 0
+    frame_size = None
+    while True:
+        packet_id = f.read(1)
+        if len(packet_id) < 1:
+            return
+        (packet_id,) = struct.unpack('=b', packet_id)
+
+        if PROFILE_PACKET_ID == packet_id:
+            data = struct.pack('=b', packet_id) + f.read(struct.calcsize(PROFILE_HEADER_FMT) - 1)
+            _, mel_filters, fft_length = struct.unpack(PROFILE_HEADER_FMT, data)[:3]
+            data += f.read(4 * (mel_filters+2 + fft_length))
+            frame_size = 1 + 4 * (mel_filters + fft_length)
+        elif GROUP_HEADER_PACKET_ID == packet_id:
+            data = struct.pack('=b', packet_id) + f.read(struct.calcsize(GROUP_HEADER_FMT) - 1)
+            _, filename_len, label_len, _ = struct.unpack(GROUP_HEADER_FMT, data)
+            data += f.read(filename_len + label_len)
+        elif FRAME_PACKET_ID == packet_id:
+            data = struct.pack('=b', packet_id) + f.read(frame_size - 1)
+        else:
+            raise Exception('unrecognized packet id %d' % packet_id)
+
+        yield packet_id, offset, data
+        offset += len(data)
+
+def parse_group_header(data):
+    _, filename_len, label_len, sample_offset = struct.unpack_from(GROUP_HEADER_FMT, data)
+    start = struct.calcsize(GROUP_HEADER_FMT)
+    return data[start:start+filename_len], data[start+filename_len:start+filename_len+label_len], sample_offset
+
+def frame_batches(frames, size=4096):
+    batch = []
+    for frame in frames:
+        batch.append(frame.mel_powers)
+        if len(batch) >= size:
+            yield np.array(batch, dtype=DTYPE)
+            batch = []
+    if batch:
+        yield np.array(batch, dtype=DTYPE)
+
+def seed_random():
+    seed = os.environ.get('NNETS_SEED')
+    if seed:
+        np.random.seed(int(seed))
+
 def oread(filename):
-    return open(filename, 'rb') if filename != '-' else sys.stdin
+    if filename == '-':
+        return sys.stdin
+    f = open(filename, 'rb')
+    # block-compressed files read like the stream they were packed from
+    if os.path.isfile(filename):
+        magic = f.read(4)
+        f.seek(0)
+        if 'MFCZ' == magic:
+            from mfcz import MFCZFile
+            return MFCZFile(f)
+    return f
 def owrite(filename):
     return open(filename, 'wb') if filename != '-' else sys.stdout
 
 ## ------------------------------------------------------------------------- ##
 
-wavelet_matrix_cache = dict()
-def get_wavelet_matrix(n):
+def wavelet_basis(n):
     M = []
     for i in xrange(n):
         A = [0.] * n
         A[i] = 1.
         wavelet.forward(A)
         M.append(A)
-    M = np.matrix(M, dtype=np.float32)
-    wavelet_matrix_cache[n] = M
-    return M
+    return np.array(M)
 
-pca_matrix = np.matrix([
+PCA_COEFFS = [
  [ -8.48677478e-02, 4.48216035e-01, 1.32214492e-01, -3.52124473e-01, 1.59988117e-01, -3.75733739e-01, 1.47300114e-01, -9.78533198e-02, 4.67698530e-01, -2.05567044e-01, 2.29368909e-01, -2.10150833e-01, 1.31653698e-01, -2.90933620e-02, 2.79265046e-02, -2.89819695e-02, -5.46065007e-03, -1.62133646e-01, -2.94567039e-02, 2.61887597e-03, -2.60637031e-07],
  [ -8.93112848e-02, 4.07818252e-01, 7.60240103e-02, -1.44458952e-01, 8.68222234e-03, -9.48834857e-02, 2.89902306e-02, 3.56490083e-02, -8.72939342e-02, 9.82927524e-02, -2.53536848e-01, 2.88575581e-01, -2.97602716e-01, 1.44045443e-01, -1.41664685e-01, 2.19243735e-01, -5.13417619e-02, 6.22652759e-01, 8.70402111e-02, 7.14463972e-03, 3.77736730e-06],
  [ -1.13174116e-01, 3.81745763e-01, 2.57829618e-02, -6.13584301e-02, -7.74654281e-02, 4.07303548e-02, -6.33515527e-02, 3.58127184e-02, -2.87628714e-01, 2.16339448e-01, -2.78272985e-01, 3.52988695e-01, -4.96394794e-02, -4.91958316e-02, 2.12574238e-01, -1.30309728e-01, 9.01379504e-02, -6.02400599e-01, -8.23327978e-02, -6.68089994e-03, -3.48907323e-06],
@@ -248,35 +578,295 @@ pca_matrix = np.matrix([
  [ -2.36208992e-01, -1.62392767e-01, -2.94245959e-01, -1.29786505e-01, 1.10340302e-01, 1.17468132e-01, 2.68067185e-01, 5.06196426e-01, 1.68358670e-01, 1.67337721e-01, 1.05743119e-01, 1.00534225e-01, -3.25449995e-02, -1.33929201e-01, -2.03121586e-01, -2.55787218e-01, 3.73981343e-01, 2.91107741e-02, 2.34121200e-01, -1.17821275e-01, -1.00130266e-06],
  [ -2.29604085e-01, -2.13933259e-01, -3.75699684e-01, -9.96870536e-02, -2.88277441e-01, -7.51633688e-02, -3.52997568e-02, 1.56545462e-01, 1.77538024e-01, 1.03099852e-01, 1.61059699e-01, 1.82878721e-01, 1.58009400e-01, 3.56829368e-01, 2.75045096e-01, 3.09612798e-01, -3.48448636e-01, -2.85754034e-02, -1.88286098e-01, 7.26556635e-02, 1.80522158e-06],
  [ -2.00446289e-01, -1.57023675e-01, -2.83550930e-01, -1.17960017e-01, -5.08955381e-01, -2.73355137e-01, -2.40348106e-01, -4.10396083e-01, -7.90629330e-02, -1.68524741e-01, -1.21592457e-01, -1.32743940e-01, -1.33447363e-01, -2.00532554e-01, -1.69973485e-01, -1.79059137e-01, 1.86798811e-01, 4.11735798e-02, 1.00316759e-01, -2.43915742e-02, -7.22767598e-07]
-], dtype=np.float32)
-
-def xmaker(mode):
-    if 'mels' == mode:
-        return lambda f : np.array(f.mel_powers, dtype=np.float32)
-
+]
+
+# The transform registry: every mode is a slice of a basis matrix over mel
+# powers, kept per (mode, mel filters, coefficient range) in this process and
+# in TRANSFORM_CACHE across processes. PCA bases only exist for the built-in
+# 21 filter profile and for filter counts pca.py -s was run on; those also
+# record the filterbank they were fitted to, and profiles with a different
+# one are refused
+TRANSFORM_COEFFS = dict(pca = (0, 10), dcts = (1, 11), wvls = (1, 11))
+TRANSFORM_CACHE = os.environ.get('NNETS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'nnets'))
+TRANSFORM_VERSION = 1
+transforms = dict()
+
+def transform_path(mode, n):
+    lo, hi = TRANSFORM_COEFFS[mode]
+    return os.path.join(TRANSFORM_CACHE, '%s-%d-%d-%d.v%d.npz' % (mode, n, lo, hi, TRANSFORM_VERSION))
+
+def build_transform(mode, n):
     if 'pca' == mode:
-        def fn(f):
-            mels = np.array(f.mel_powers, dtype=np.float32)
-            return np.array(mels * pca_matrix[:, 0:10]).ravel()
-        return fn
-
+        if n != len(PCA_COEFFS):
+            raise ValueError('no pca basis for %d mel filters; make one with pca.py -s' % n)
+        return np.array(PCA_COEFFS)
     if 'dcts' == mode:
-        def fn(f):
-            mels = np.array(f.mel_powers, dtype=np.float32)
-            return scipy.fftpack.dct(mels, type=2)[1:11]
-        return fn
-
+        return fftpack.dct(np.identity(n), type=2)
     if 'wvls' == mode:
-        def fn(f):
-            mels = np.array(f.mel_powers, dtype=np.float32)
-            n = len(f.mel_powers)
-            M = wavelet_matrix_cache[n] if n in wavelet_matrix_cache else get_wavelet_matrix(n)
-            return np.array(mels * M[:, 1:11]).ravel()
-        return fn
-
+        return wavelet_basis(n)
     raise ValueError('unrecognized mode; must be mels, pca, dcts or wvls')
 
+def save_transform(mode, M, mel_freqs=None):
+    # M is the full basis; the file is renamed into place so processes
+    # racing to save the same one never see it half written
+    lo, hi = TRANSFORM_COEFFS[mode]
+    path = transform_path(mode, M.shape[0])
+    if not os.path.isdir(TRANSFORM_CACHE):
+        os.makedirs(TRANSFORM_CACHE)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, matrix = np.asarray(M, dtype=np.float64)[:, lo:hi],
+                 mel_freqs = np.asarray(mel_freqs if mel_freqs is not None else [], dtype=np.float64))
+    os.rename(tmp, path)
+    transforms.pop((mode, M.shape[0]), None)
+
+def load_transform(mode, n):
+    # the matrix and filterbank in the cache, or None if it has no usable one
+    lo, hi = TRANSFORM_COEFFS[mode]
+    try:
+        with open(transform_path(mode, n), 'rb') as f:
+            data = np.load(f)
+            M, mel_freqs = data['matrix'], data['mel_freqs']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    if M.shape != (n, hi - lo):
+        return None
+    return M, mel_freqs if len(mel_freqs) else None
+
+def transform_matrix(mode, n, profile=None):
+    key = (mode, n)
+    if key not in transforms:
+        builtin = 'pca' == mode and n == len(PCA_COEFFS)
+        cached = None if builtin else load_transform(mode, n)
+        if cached is None:
+            lo, hi = TRANSFORM_COEFFS[mode]
+            M = build_transform(mode, n)
+            if not builtin:
+                try:
+                    save_transform(mode, M)
+                except (IOError, OSError):
+                    pass # a read-only cache only costs rebuilding
+            cached = M[:, lo:hi], None
+        transforms[key] = cached[0].astype(DTYPE), cached[1]
+
+    M, mel_freqs = transforms[key]
+    if profile is not None and mel_freqs is not None and \
+       not np.allclose(mel_freqs, profile.mel_freqs, rtol=1e-4):
+        raise ValueError('the %s basis for %d mel filters was fitted to another filterbank than this profile has' % (mode, n))
+    return M
+
+def feature_matrix(mode, n, profile=None):
+    if 'mels' == mode:
+        return np.identity(n, dtype=DTYPE)
+    if mode not in TRANSFORM_COEFFS:
+        raise ValueError('unrecognized mode; must be mels, pca, dcts or wvls')
+    return transform_matrix(mode, n, profile)
+
+def batch_xmaker(mode):
+    # the matrix for a filter count is checked again whenever a new profile
+    # comes along
+    matrices = dict()
+    profiles = dict()
+    def fn(mels, profile=None):
+        n = mels.shape[1]
+        if n not in matrices or (profile is not None and profile is not profiles.get(n)):
+            matrices[n] = feature_matrix(mode, n, profile)
+            profiles[n] = profile
+        return np.dot(mels, matrices[n])
+    return fn
+
+def xmaker(mode):
+    if 'mels' == mode:
+        return lambda f : np.array(f.mel_powers, dtype=DTYPE)
+    makeX = batch_xmaker(mode)
+    return lambda f : makeX(np.array([f.mel_powers], dtype=DTYPE), f.group_header.profile)[0]
+
 def is_clipped(f):
     threshold = 0.5 + f.group_header.profile.mel_power_threshold
     return any([ v < threshold for v in f.mel_powers ])
 
+## ------------------------------------------------------------------------- ##
+
+# context modes look like pca@2+dd: the base mode, then optionally the number
+# of neighbour frames stacked on each side, then optionally deltas (+d) or
+# deltas and delta-deltas (+dd); segments are padded by repeating edge frames
+
+DELTA_WINDOW = 2
+
+def parse_mode(mode):
+    base, _, deltas = mode.partition('+')
+    base, _, width = base.partition('@')
+    if deltas not in ('', 'd', 'dd') or not (width or '0').isdigit():
+        raise ValueError('malformed mode %s; expected e.g. pca, pca@2 or pca@2+dd' % mode)
+    return base, int(width or 0), len(deltas)
+
+def context_pad(width, order):
+    return width + DELTA_WINDOW * order
+
+def continues(prev, frame):
+    return frame.group_header is prev.group_header and \
+           frame.sample_offset == prev.sample_offset + frame.group_header.profile.frame_spacing
+
+def pad_rows(F, pad):
+    return np.concatenate(( np.repeat(F[:1], pad, axis=0), F, np.repeat(F[-1:], pad, axis=0) ))
+
+def delta_rows(F, order):
+    N = DELTA_WINDOW
+    parts = [F]
+    for i in xrange(order):
+        last = parts[-1]
+        T = len(last) - 2*N
+        D = sum( n * (last[N+n:N+n+T] - last[N-n:N-n+T]) for n in xrange(1, N+1) )
+        parts = [ p[N:N+T] for p in parts ] + [ D / (2. * sum( n*n for n in xrange(1, N+1) )) ]
+    return np.ascontiguousarray(np.hstack(parts))
+
+def stack_context(F, width):
+    # row i is F[i:i+2*width+1] flattened, without copying F
+    F = np.ascontiguousarray(F)
+    return np.lib.stride_tricks.as_strided(F,
+        shape = (len(F) - 2*width, (2*width+1) * F.shape[1]),
+        strides = F.strides)
+
+def window_matrix(mode, n):
+    # every mode is linear in the 2*context_pad+1 frames of n mel powers it
+    # looks at; row j*n+i is what mel i of window frame j contributes
+    base, width, order = parse_mode(mode)
+    M = feature_matrix(base, n)
+    frames = 2*context_pad(width, order) + 1
+
+    rows = []
+    for j in xrange(frames):
+        for i in xrange(n):
+            F = np.zeros((frames, M.shape[1]), dtype=M.dtype)
+            F[j] = M[i]
+            rows.append(stack_context(delta_rows(F, order), width)[0])
+    return np.array(rows)
+
+class ContextWindow(object):
+    __slots__ = ('makeX', 'width', 'order', 'rows', 'frames', 'last')
+
+    def __init__(self, mode):
+        base, self.width, self.order = parse_mode(mode)
+        self.makeX = batch_xmaker(base)
+        self.rows = collections.deque(maxlen = 2*context_pad(self.width, self.order) + 1)
+        self.frames = collections.deque()
+        self.last = None
+
+    def _emit(self):
+        F = delta_rows(np.array(self.rows), self.order)
+        return self.frames.popleft(), stack_context(F, self.width)[0]
+
+    def push(self, frame):
+        ready = []
+        if self.last is not None and not continues(self.last, frame):
+            ready = self.flush()
+
+        x = self.makeX(np.array([frame.mel_powers], dtype=DTYPE), frame.group_header.profile)[0]
+        if not self.rows:
+            self.rows.extend([x] * (self.rows.maxlen // 2))
+        self.rows.append(x)
+        self.frames.append(frame)
+        self.last = frame
+
+        if len(self.rows) == self.rows.maxlen:
+            ready.append(self._emit())
+        return ready
+
+    def flush(self):
+        ready = []
+        while self.frames:
+            self.rows.append(self.rows[-1])
+            if len(self.rows) == self.rows.maxlen:
+                ready.append(self._emit())
+        self.rows.clear()
+        self.last = None
+        return ready
+
+## ------------------------------------------------------------------------- ##
+
+class Histograms(object):
+    __slots__ = ('lo', 'hi', 'bins', 'counts', 'sums', 'n')
+
+    def __init__(self, rows, lo, hi, bins=100):
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.bins = bins
+        self.counts = np.zeros((rows, bins), dtype=np.int64)
+        self.sums = np.zeros(rows)
+        self.n = 0
+
+    def add(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        rows = self.counts.shape[0]
+        if X.shape[1] != rows:
+            raise ValueError('%d values per row for %d histograms; the profile changed?' % (X.shape[1], rows))
+
+        # values out of range count in the edge bins, so the percentiles are
+        # of the same population the sums and mean are
+        idx = np.floor((X - self.lo) * (self.bins / (self.hi - self.lo))).astype(np.int64)
+        idx = np.clip(idx, 0, self.bins - 1) + np.arange(rows) * self.bins
+
+        self.counts += np.bincount(idx.ravel(), minlength=rows*self.bins).reshape((rows, self.bins))
+        self.sums += X.sum(axis=0)
+        self.n += X.shape[0]
+
+    def merge(self, other):
+        self.add_counts(other.counts, other.sums, other.n)
+
+    def add_counts(self, counts, sums, n):
+        self.counts += counts
+        self.sums += sums
+        self.n += n
+
+    def centers(self):
+        width = (self.hi - self.lo) / self.bins
+        return self.lo + width * (np.arange(self.bins) + .5)
+
+    def mean(self):
+        return self.sums / max(self.n, 1)
+
+    def percentiles(self, q):
+        width = (self.hi - self.lo) / self.bins
+        cum = np.cumsum(self.counts, axis=1)
+        P = np.empty((len(q), self.counts.shape[0]))
+        for i, row in enumerate(cum):
+            target = np.asarray(q, dtype=np.float64) / 100. * row[-1]
+            # find the bin that crosses each fraction and interpolate inside it
+            j = np.minimum(np.searchsorted(row, target), self.bins-1)
+            below = np.where(j > 0, row[j-1], 0)
+            inbin = np.maximum(self.counts[i, j], 1)
+            P[:, i] = self.lo + width * (j + (target - below) / inbin)
+        return P
+
+def write_histograms(f, titles, histograms, xs=None):
+    # xs holds the x value of every bin of every row if they are not the
+    # shared bin centers
+    if xs is None:
+        xs = itertools.repeat(histograms.centers())
+    for title, x, counts in itertools.izip(titles, xs, histograms.counts):
+        f.write('%s\n' % title)
+        for c, n in itertools.izip(x, counts):
+            f.write('%f %d\n' % (c, n))
+        f.write('\n\n')
+
+# benchmark baselines, as stored by the bench-* scripts: the runs of the last
+# good measurement, along with fields that must match for them to compare
+def load_baseline(filename, **fields):
+    if not filename or not os.path.exists(filename):
+        return dict()
+    with open(filename) as f:
+        stored = json.load(f)
+    if any( stored.get(k) != v for k, v in fields.iteritems() ):
+        return dict()
+    return stored.get('runs', dict())
+
+def save_baseline(filename, baseline, results, regressed, update, **fields):
+    # a regressed run only replaces the baseline with update; whatever was
+    # not measured this time keeps its old results
+    if regressed and not update:
+        sys.stderr.write('kept the old results in %s, rerun with --update to replace them\n' % filename)
+        return
+    runs = dict(baseline)
+    runs.update(results)
+    with open(filename, 'w') as f:
+        json.dump(dict(fields, runs = runs), f, indent=1, sort_keys=True)
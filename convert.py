@@ -0,0 +1,127 @@
+#!./python
+
+import sys, os, getopt, hashlib, subprocess
+import multiprocessing.pool
+from common import *
+
+MLF_MAGIC = '#!MLF!#'
+
+class Unit(object):
+    __slots__ = ('args', 'stdin', 'cwd', 'inputs', 'key')
+
+    def __init__(self, args, stdin, cwd, inputs):
+        self.args = args
+        self.stdin = stdin
+        self.cwd = cwd
+        self.inputs = inputs
+        self.key = hashlib.sha1(repr((args, stdin, cwd))).hexdigest()
+
+def mlf_entries(filename):
+    entries = []
+    with open(filename, 'r') as f:
+        if not f.readline().startswith(MLF_MAGIC):
+            raise ValueError('%s is not an MLF file' % filename)
+        for line in f:
+            if line.startswith('"'):
+                entries.append([])
+            if entries:
+                entries[-1].append(line)
+    return entries
+
+def mlf_sources(basedir, entry):
+    # same name mangling as mlf_label_source::next_source
+    name = entry[0].rstrip('\r\n')[3:]
+    return os.path.join(basedir, name.split('.', 1)[0] + '.ogg')
+
+def make_units(inputs, chunks):
+    units = []
+    for filename in inputs:
+        with open(filename, 'rb') as f:
+            is_mlf = f.read(len(MLF_MAGIC)) == MLF_MAGIC
+        path = os.path.realpath(filename)
+
+        if not is_mlf:
+            units.append(Unit([filename], None, None, [path]))
+            continue
+
+        # an MLF is cut into pieces fed through stdin from its directory, so
+        # that mfcc resolves and names sound files exactly as for the whole MLF
+        basedir = os.path.dirname(path)
+        entries = mlf_entries(filename)
+        step = max(1, (len(entries) + chunks - 1) / chunks)
+        for i in xrange(0, len(entries), step):
+            piece = entries[i:i+step]
+            text = MLF_MAGIC + '\n' + ''.join(line for entry in piece for line in entry)
+            sources = [ mlf_sources(basedir, entry) for entry in piece ]
+            units.append(Unit(['-'], text, basedir, [path] + sources))
+    return units
+
+def up_to_date(part, inputs):
+    if not os.path.exists(part):
+        return False
+    mtime = os.path.getmtime(part)
+    return all( os.path.exists(x) and os.path.getmtime(x) <= mtime for x in inputs )
+
+def run_unit(converter, flags, unit, part):
+    tmp = part + '.tmp'
+    with open(tmp, 'wb') as out_file:
+        p = subprocess.Popen([converter] + flags + unit.args, cwd=unit.cwd,
+                             stdin=subprocess.PIPE if unit.stdin is not None else None,
+                             stdout=out_file)
+        p.communicate(unit.stdin)
+    if 0 != p.returncode:
+        os.unlink(tmp)
+        raise RuntimeError('%s failed on %s' % (converter, ' '.join(unit.args) if unit.stdin is None else unit.cwd))
+    os.rename(tmp, part)
+
+def merge(parts, out_file):
+    last_profile = None
+    for part in parts:
+        with open(part, 'rb') as f:
+            for packet_id, _, data in raw_packets(f):
+                if PROFILE_PACKET_ID == packet_id:
+                    if data == last_profile:
+                        continue
+                    last_profile = data
+                out_file.write(data)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'j:uc:', ['no-fft', 'mfcc='])
+    except getopt.GetoptError:
+        args = []
+    if len(args) < 2:
+        sys.stderr.write('USAGE: convert.py [-j jobs] [-u] [-c cache dir] [--no-fft] [--mfcc converter] [output mfcc file] [input...]\n')
+        sys.exit(1)
+    opts = dict(opts)
+
+    jobs = int(opts.get('-j', multiprocessing.cpu_count()))
+    converter = os.path.realpath(opts.get('--mfcc', './mfcc'))
+    flags = ['--no-fft'] if '--no-fft' in opts else []
+    output, inputs = args[0], args[1:]
+    cache = opts.get('-c', output + '.parts')
+    update = '-u' in opts
+
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+
+    units = make_units(inputs, 4 * jobs)
+    parts = []
+    todo = []
+    for unit in units:
+        part = os.path.join(cache, hashlib.sha1(repr((flags, unit.key))).hexdigest() + '.mfcc')
+        parts.append(part)
+        if not (update and up_to_date(part, unit.inputs + [converter])):
+            todo.append((unit, part))
+
+    sys.stderr.write('converting %d of %d pieces with %d jobs\n' % (len(todo), len(units), jobs))
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    pool.map(lambda (unit, part): run_unit(converter, flags, unit, part), todo, chunksize=1)
+    pool.close()
+
+    sys.stderr.write('merging into %s\n' % output)
+    with owrite(output) as out_file:
+        merge(parts, out_file)
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,27 @@
 
 import sys, re
 from common import *
+from index import load_index, copy_groups
 
 def main():
     if len(sys.argv) != 5:
         sys.stderr.write('USAGE: extract-sounds.py [filename regexp] [label regexp] [input mfcc file] [output mfcc file]\n')
         sys.exit(1)
 
+    index = load_index(sys.argv[3]) if sys.argv[3] != '-' else None
+    if index is not None:
+        groups = index.select(sys.argv[1], sys.argv[2])
+        for i in groups:
+            print 'matched filename %s, label %s' % (index.filenames[i], index.labels[i])
+        with oread(sys.argv[3]) as in_file:
+            with owrite(sys.argv[4]) as out_file:
+                copy_groups(index, groups, in_file, out_file)
+        return
+
     filename_re = re.compile(sys.argv[1])
     label_re = re.compile(sys.argv[2])
 
-    in_file = open(sys.argv[3], 'rb') if sys.argv[1] != '-' else sys.stdin
+    in_file = oread(sys.argv[3])
     reader = MFCCReader(in_file)
 
     out_file = open(sys.argv[4], 'wb') if sys.argv[2] != '-' else sys.stdout
@@ -0,0 +1,214 @@
+#!./python
+
+import sys, wave
+import numpy as np
+from common import *
+
+# defaults of the config struct in mfcc.C
+FRAME_SEC = .020
+STEP_SEC = .005
+MEL_FILTERS = 21
+MEL_HIGH_FREQ = 4270.
+MEL_POWER_THRESHOLD = -70.
+
+f32 = np.float32
+
+def hz_to_mel(hz):
+    return f32(1125.) * np.log1p(hz / f32(700.))
+def mel_to_hz(mel):
+    return f32(700.) * (np.exp(mel / f32(1125.)) - f32(1.))
+def power_to_db(p):
+    with np.errstate(divide='ignore'):
+        return np.log(p) * f32(4.3429448)
+def db_to_power(p):
+    return np.exp(f32(0.23025851) * f32(p))
+
+def make_profile(sample_rate, mel_filters=MEL_FILTERS, mel_high_freq=MEL_HIGH_FREQ,
+                 mel_power_threshold=MEL_POWER_THRESHOLD, fft=True):
+    frame_length = int(f32(FRAME_SEC) * f32(sample_rate))
+    frame_spacing = int(f32(STEP_SEC) * f32(sample_rate))
+    fft_length = frame_length / 2
+
+    mel_step = hz_to_mel(f32(mel_high_freq)) / f32(mel_filters+1)
+    mel_freqs = mel_to_hz(mel_step * np.arange(mel_filters+2, dtype=f32))
+    fft_freqs = (sample_rate * np.arange(fft_length)).astype(f32) / f32(frame_length)
+
+    return ProfilePacket(
+        seq = 1,
+        frame_length = frame_length,
+        frame_spacing = frame_spacing,
+        sample_rate = sample_rate,
+        mel_power_threshold = mel_power_threshold,
+        mel_filters = mel_filters,
+        fft_length = fft_length if fft else 0,
+        mel_freqs = map(float, mel_freqs),
+        fft_freqs = map(float, fft_freqs) if fft else [])
+
+class Frontend(object):
+    __slots__ = ('profile', 'fft_length', 'window', 'filterbank', 'mel_power_offs')
+
+    def __init__(self, profile):
+        self.profile = profile
+        N = profile.frame_length
+        self.fft_length = N / 2
+
+        i = np.arange(N, dtype=f32)
+        self.window = f32(.5) - f32(.5) * np.cos(f32(2. * np.pi) * i / f32(N))
+
+        # triangular filters exactly as in mfcc::process_frame, one row per filter
+        freqs = (profile.sample_rate * np.arange(self.fft_length)).astype(f32) / f32(N)
+        mel_freqs = np.array(profile.mel_freqs, dtype=f32)
+        self.filterbank = np.zeros((profile.mel_filters, self.fft_length), dtype=f32)
+        for j in xrange(profile.mel_filters):
+            lo, mid, high = mel_freqs[j:j+3]
+            rising = (freqs > lo) & (freqs < mid)
+            falling = (freqs >= mid) & (freqs < high)
+            self.filterbank[j, rising] = (freqs[rising] - lo) / (mid - lo)
+            self.filterbank[j, falling] = (high - freqs[falling]) / (high - mid)
+
+        self.mel_power_offs = db_to_power(profile.mel_power_threshold)
+
+    def signal(self, samples):
+        samples = np.asarray(samples, dtype=np.int16)
+        x = samples.astype(f32) / f32(32768.)
+        if 2 == x.ndim:
+            x = f32(.5) * x.sum(axis=1) if 2 == x.shape[1] else x[:, 0]
+
+        # like the C++ streamer: a frame starts at every frame_spacing-th sample
+        # before the end, and the last ones are padded with zeros
+        p = self.profile
+        n = (len(x) + p.frame_spacing - 1) / p.frame_spacing
+        padded = np.zeros((n-1) * p.frame_spacing + p.frame_length if n else 0, dtype=f32)
+        padded[:len(x)] = x
+        return padded, n
+
+    def process(self, samples, chunk=4096):
+        padded, n = self.signal(samples)
+        p = self.profile
+        frames = np.lib.stride_tricks.as_strided(padded,
+            shape = (n, p.frame_length),
+            strides = (p.frame_spacing * padded.itemsize, padded.itemsize))
+
+        for start in xrange(0, n, chunk):
+            yield self.process_frames(frames[start:start+chunk])
+
+    def process_frames(self, frames):
+        N = self.profile.frame_length
+        spectrum = np.fft.rfft(frames * self.window, axis=1)[:, :self.fft_length]
+        spectrum = spectrum.astype(np.complex64)
+
+        re = spectrum.real / f32(N)
+        im = spectrum.imag / f32(N)
+        fft_power = re*re + im*im
+        fft_power[:, 1:] *= f32(2.)
+
+        mel_power = power_to_db(np.dot(fft_power, self.filterbank.T) + self.mel_power_offs)
+        return mel_power.astype(f32), power_to_db(fft_power).astype(f32)
+
+def read_samples(filename):
+    with open(filename, 'rb') as f:
+        riff = f.read(4) == 'RIFF'
+    if not riff:
+        # mfcc.C treats anything that is not a wav file as raw 16kHz mono
+        return 16000, np.fromfile(filename, dtype='<i2')
+
+    w = wave.open(filename, 'rb')
+    try:
+        if 2 != w.getsampwidth():
+            raise ValueError('only 16 bits per sample streams are supported')
+        data = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
+        return w.getframerate(), data.reshape((-1, w.getnchannels()))
+    finally:
+        w.close()
+
+class WaveReader(object):
+    def __init__(self, filename, label='?', chunk=4096):
+        sample_rate, samples = read_samples(filename)
+        self.current_profile = make_profile(sample_rate)
+        self.current_group_header = GroupHeaderPacket(
+            seq = 1,
+            profile = self.current_profile,
+            filename = filename,
+            label = label,
+            sample_offset = 0)
+        self.seekable = False
+        self._packets = self._generate(Frontend(self.current_profile).process(samples, chunk))
+
+    def _generate(self, chunks):
+        yield self.current_profile
+        yield self.current_group_header
+
+        seq = 0
+        spacing = self.current_profile.frame_spacing
+        for mel_power, fft_power in chunks:
+            for mel, fft in itertools.izip(mel_power.tolist(), fft_power.tolist()):
+                yield FramePacket(
+                    seq = seq + 1,
+                    group_header = self.current_group_header,
+                    mel_powers = mel,
+                    fft_powers = fft,
+                    sample_offset = seq * spacing)
+                seq += 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._packets)
+
+def write_frames(f, mel_power, fft_power):
+    dtype = [ ('id', 'i1'), ('mel', '<f4', mel_power.shape[1:]), ('fft', '<f4', fft_power.shape[1:]) ]
+    packets = np.empty(len(mel_power), dtype=dtype)
+    packets['id'] = FRAME_PACKET_ID
+    packets['mel'] = mel_power
+    packets['fft'] = fft_power
+    f.write(packets.tostring())
+
+def convert(filename, out_file, label):
+    sample_rate, samples = read_samples(filename)
+    profile = make_profile(sample_rate)
+
+    writer = MFCCWriter(out_file)
+    writer.write(profile)
+    writer.write(GroupHeaderPacket(seq = 1, profile = profile, filename = filename,
+                                   label = label, sample_offset = 0))
+    for mel_power, fft_power in Frontend(profile).process(samples):
+        write_frames(out_file, mel_power, fft_power)
+
+def compare(filename, mfcc_filename):
+    mels = []
+    ffts = []
+    with oread(mfcc_filename) as in_file:
+        for packet in MFCCReader(in_file):
+            if isinstance(packet, FramePacket):
+                mels.append(packet.mel_powers)
+                ffts.append(packet.fft_powers)
+    mels = np.array(mels, dtype=f32)
+    ffts = np.array(ffts, dtype=f32)
+
+    sample_rate, samples = read_samples(filename)
+    chunks = list(Frontend(make_profile(sample_rate)).process(samples))
+    mel_power = np.vstack([ m for m, _ in chunks ])
+    fft_power = np.vstack([ f for _, f in chunks ])
+
+    print 'frames: %d from mfcc file, %d computed' % (len(mels), len(mel_power))
+    if len(mels) != len(mel_power):
+        return
+    print 'max mel power difference: %g dB' % np.abs(mels - mel_power).max()
+    if ffts.size:
+        finite = np.isfinite(ffts) & np.isfinite(fft_power)
+        print 'max fft power difference: %g dB' % np.abs(ffts - fft_power)[finite].max()
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        return compare(sys.argv[2], sys.argv[3])
+    if len(sys.argv) in (3,4):
+        with owrite(sys.argv[2]) as out_file:
+            return convert(sys.argv[1], out_file, sys.argv[3] if len(sys.argv) > 3 else '?')
+
+    sys.stderr.write('USAGE: frontend.py [input wav file] [output mfcc file] [label]\n'
+                     '       frontend.py compare [input wav file] [mfcc file written by mfcc]\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!./python
+
+import sys, collections
+import multiprocessing
+from common import *
+
+MODE_TAGS = dict(mels='mel', pca='pca', dcts='dct', wvls='wvl')
+
+# histograms are of all n coefficients of the full basis, not just the ones
+# the features use, except for pca bases saved by pca.py -s, which only
+# keep those; by default every (label, coefficient) block has bins from its
+# own smallest to its largest value, the layout of histo/ch.dct and
+# histo/ch.wvl, which takes two passes. histo/plotcmd.sh needs to be told
+# the block and label counts, which are reported at the end
+bases = dict()
+def basis(mode, n):
+    if (mode, n) not in bases:
+        if 'mels' == mode:
+            bases[mode, n] = np.identity(n)
+        elif 'pca' == mode and n != len(PCA_COEFFS):
+            bases[mode, n] = transform_matrix(mode, n).astype(np.float64)
+        else:
+            bases[mode, n] = build_transform(mode, n)
+    return bases[mode, n]
+
+def range_batch(args):
+    mode, label, mels = args
+    X = np.dot(mels, basis(mode, mels.shape[1]))
+    return label, X.min(axis=0), X.max(axis=0)
+
+def histogram_batch(args):
+    mode, lo, hi, bins, label, mels = args
+    X = np.dot(mels, basis(mode, mels.shape[1]))
+    h = Histograms(X.shape[1], lo, hi, bins)
+    h.add(X)
+    return label, h.counts, h.sums, h.n
+
+def scaled_batch(args):
+    # values scaled so bin i starts at lo + i*(hi-lo)/(bins-1) of their
+    # block and the largest value falls into the last bin
+    mode, lo, hi, bins, label, mels = args
+    X = np.dot(mels, basis(mode, mels.shape[1]))
+    span = np.where(hi > lo, hi - lo, 1.)
+    h = Histograms(X.shape[1], 0., bins, bins)
+    # clipped, as batches of other shapes may round the extremes differently
+    h.add(np.clip((X - lo) * ((bins - 1) / span), 0., bins - 1))
+    return label, h.counts, X.sum(axis=0), h.n
+
+def label_batches(reader, size=4096):
+    pending = collections.defaultdict(list)
+    for packet in reader:
+        if not isinstance(packet, FramePacket) or is_clipped(packet):
+            continue
+        label = packet.group_header.label
+        batch = pending[label]
+        batch.append(packet.mel_powers)
+        if len(batch) >= size:
+            yield label, np.array(batch, dtype=np.float64)
+            del pending[label]
+    for label, batch in pending.iteritems():
+        yield label, np.array(batch, dtype=np.float64)
+
+def run_tasks(fn, tasks, processes, merge):
+    if processes <= 1:
+        for task in tasks:
+            merge(fn(task))
+        return
+
+    pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fn, (task,)))
+        # keep only a few batches in flight so memory stays bounded
+        while len(pending) > 2*processes:
+            merge(pending.popleft().get())
+    while pending:
+        merge(pending.popleft().get())
+    pool.close()
+    pool.join()
+
+def main():
+    if len(sys.argv) not in (5,6):
+        sys.stderr.write('USAGE: histo.py [mode] [bins, or lo:hi:bins for one range] [input mfcc file] [output file] [processes]\n')
+        sys.exit(1)
+
+    mode = sys.argv[1]
+    if mode not in MODE_TAGS:
+        raise ValueError('unrecognized mode; must be mels, pca, dcts or wvls')
+    if ':' in sys.argv[2]:
+        lo, hi, bins = sys.argv[2].split(':')
+        lo, hi, bins = float(lo), float(hi), int(bins)
+    else:
+        lo = hi = None
+        bins = int(sys.argv[2])
+        if '-' == sys.argv[3]:
+            raise ValueError('per-block ranges take two passes over the input, which cannot be stdin')
+    processes = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+
+    ranges = dict()
+    def merge_range(result):
+        label, bottom, top = result
+        if label in ranges:
+            bottom = np.minimum(bottom, ranges[label][0])
+            top = np.maximum(top, ranges[label][1])
+        ranges[label] = bottom, top
+
+    if lo is None:
+        with oread(sys.argv[3]) as in_file:
+            tasks = ( (mode, label, mels) for label, mels in label_batches(MFCCReader(in_file)) )
+            run_tasks(range_batch, tasks, processes, merge_range)
+
+    histograms = dict()
+    def merge(result):
+        label, counts, sums, n = result
+        if label not in histograms:
+            if lo is None:
+                histograms[label] = Histograms(counts.shape[0], 0., bins, bins)
+            else:
+                histograms[label] = Histograms(counts.shape[0], lo, hi, bins)
+        histograms[label].add_counts(counts, sums, n)
+
+    with oread(sys.argv[3]) as in_file:
+        if lo is None:
+            tasks = ( (mode, ranges[label][0], ranges[label][1], bins, label, mels)
+                      for label, mels in label_batches(MFCCReader(in_file)) )
+            run_tasks(scaled_batch, tasks, processes, merge)
+        else:
+            tasks = ( (mode, lo, hi, bins, label, mels)
+                      for label, mels in label_batches(MFCCReader(in_file)) )
+            run_tasks(histogram_batch, tasks, processes, merge)
+
+    with owrite(sys.argv[4]) as out_file:
+        for label in sorted(histograms):
+            h = histograms[label]
+            titles = [ '%s-%s-%d' % (label, MODE_TAGS[mode], i) for i in xrange(h.counts.shape[0]) ]
+            xs = None
+            if lo is None:
+                bottom, top = ranges[label]
+                xs = bottom[:, np.newaxis] + (top - bottom)[:, np.newaxis] * (np.arange(bins) / (bins - 1.))
+            write_histograms(out_file, titles, h, xs)
+            sys.stderr.write('label %s: %d frames\n' % (label, h.n))
+
+    blocks = set( h.counts.shape[0] for h in histograms.itervalues() )
+    if len(blocks) > 1:
+        sys.stderr.write('warning: labels have different block counts (%s), input mixes profiles\n' %
+                         ', '.join(map(str, sorted(blocks))))
+    elif blocks:
+        n = blocks.pop()
+        sys.stderr.write('%d blocks per label, %d labels; plot with plotcmd.sh %d %d\n' % (
+                         n, len(histograms), n, len(histograms)))
+
+if __name__ == '__main__':
+    main()
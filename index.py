@@ -0,0 +1,175 @@
+#!./python
+
+import sys, os, re, collections
+import cPickle as pickle
+from common import *
+
+INDEX_VERSION = 1
+
+def index_filename(mfcc_filename):
+    return mfcc_filename + '.idx'
+
+def speaker(filename):
+    return filename.lstrip('/').split('/', 1)[0]
+
+class MFCCIndex(object):
+    __slots__ = ('profiles', 'starts', 'ends', 'frames', 'profile_ids',
+                 'filenames', 'labels', 'by_filename', 'by_label')
+
+    def __init__(self, profiles, starts, ends, frames, profile_ids, filenames, labels):
+        self.profiles = profiles
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.profile_ids = np.asarray(profile_ids, dtype=np.int32)
+        self.filenames = filenames
+        self.labels = labels
+
+        self.by_filename = collections.defaultdict(list)
+        self.by_label = collections.defaultdict(list)
+        for i, (filename, label) in enumerate(itertools.izip(filenames, labels)):
+            self.by_filename[filename].append(i)
+            self.by_label[label].append(i)
+
+    def select(self, filename_re, label_re):
+        filename_re = re.compile(filename_re)
+        label_re = re.compile(label_re)
+        by_filename = [ i for filename, groups in self.by_filename.iteritems()
+                          if filename_re.match(filename) for i in groups ]
+        by_label = [ i for label, groups in self.by_label.iteritems()
+                       if label_re.match(label) for i in groups ]
+        return np.intersect1d(by_filename, by_label).astype(np.int64)
+
+    def all(self):
+        return np.arange(len(self.starts))
+
+    def label_frames(self, groups):
+        counts = collections.Counter()
+        for i in groups:
+            counts[self.labels[i]] += self.frames[i]
+        return counts
+
+    def speaker_frames(self, groups):
+        counts = collections.Counter()
+        for i in groups:
+            counts[speaker(self.filenames[i])] += self.frames[i]
+        return counts
+
+def build_index(f):
+    profiles = []
+    starts, ends, frames, profile_ids, filenames, labels = [], [], [], [], [], []
+
+    def close_group(offset):
+        if len(ends) < len(starts):
+            ends.append(offset)
+
+    end = 0
+    for packet_id, offset, data in raw_packets(f):
+        end = offset + len(data)
+        if FRAME_PACKET_ID == packet_id:
+            if len(ends) == len(starts):
+                # frames right after a profile continue the previous group
+                starts.append(offset)
+                frames.append(0)
+                profile_ids.append(len(profiles)-1)
+                filenames.append(filenames[-1] if filenames else '')
+                labels.append(labels[-1] if labels else '')
+            frames[-1] += 1
+            continue
+
+        close_group(offset)
+        if PROFILE_PACKET_ID == packet_id:
+            profiles.append((offset, data))
+        else:
+            filename, label, _ = parse_group_header(data)
+            starts.append(offset)
+            frames.append(0)
+            profile_ids.append(len(profiles)-1)
+            filenames.append(filename)
+            labels.append(label)
+    close_group(end)
+
+    return MFCCIndex(profiles, starts, ends, frames, profile_ids, filenames, labels)
+
+def save_index(mfcc_filename, index):
+    st = os.stat(mfcc_filename)
+    with open(index_filename(mfcc_filename), 'wb') as f:
+        pickle.dump(dict(
+            version = INDEX_VERSION,
+            size = st.st_size,
+            mtime = st.st_mtime,
+            profiles = index.profiles,
+            starts = index.starts,
+            ends = index.ends,
+            frames = index.frames,
+            profile_ids = index.profile_ids,
+            filenames = index.filenames,
+            labels = index.labels),
+            f, -1)
+
+def load_index(mfcc_filename):
+    try:
+        st = os.stat(mfcc_filename)
+        with open(index_filename(mfcc_filename), 'rb') as f:
+            data = pickle.load(f)
+    except (IOError, OSError):
+        return None
+    if data['version'] != INDEX_VERSION or data['size'] != st.st_size or data['mtime'] != st.st_mtime:
+        return None
+    return MFCCIndex(data['profiles'], data['starts'], data['ends'], data['frames'],
+                     data['profile_ids'], data['filenames'], data['labels'])
+
+def copy_groups(index, groups, in_file, out_file):
+    # profiles are copied in file order, as extract-sounds.py does without an index
+    events = [ (offset, None, data) for offset, data in index.profiles ] + \
+             [ (index.starts[i], i, None) for i in groups ]
+    for offset, i, data in sorted(events):
+        if i is None:
+            out_file.write(data)
+            continue
+        in_file.seek(offset)
+        out_file.write(in_file.read(index.ends[i] - index.starts[i]))
+
+def print_stats(index, groups):
+    print 'groups: %d, frames: %d' % (len(groups), index.frames[groups].sum())
+    print 'frames per label:'
+    for label, n in sorted(index.label_frames(groups).iteritems()):
+        print '\t%s\t%d' % (label, n)
+    print 'frames per speaker:'
+    for name, n in sorted(index.speaker_frames(groups).iteritems()):
+        print '\t%s\t%d' % (name, n)
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == 'build':
+        with oread(sys.argv[2]) as f:
+            index = build_index(f)
+        save_index(sys.argv[2], index)
+        print 'indexed %d groups, %d frames into %s' % (
+            len(index.starts), index.frames.sum(), index_filename(sys.argv[2]))
+        return
+
+    if len(sys.argv) in (3,5) and sys.argv[1] in ('stats', 'query'):
+        index = load_index(sys.argv[-1])
+        if index is None:
+            sys.stderr.write('no up to date index for %s; run index.py build first\n' % sys.argv[-1])
+            sys.exit(1)
+
+        if len(sys.argv) == 3:
+            return print_stats(index, index.all())
+
+        groups = index.select(sys.argv[2], sys.argv[3])
+        if sys.argv[1] == 'query':
+            for i in groups:
+                print '%d\t%d\t%d\t%s\t%s' % (index.starts[i], index.ends[i], index.frames[i],
+                                              index.filenames[i], index.labels[i])
+        else:
+            print_stats(index, groups)
+        return
+
+    sys.stderr.write('USAGE: index.py build [mfcc file]\n'
+                     '       index.py stats [mfcc file]\n'
+                     '       index.py [query|stats] [filename regexp] [label regexp] [mfcc file]\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!./python
+
+import sys, struct, zlib, bz2, bisect, collections
+import multiprocessing, multiprocessing.pool
+from common import *
+
+# An mfcz file is an mfcc stream cut into blocks of whole packets that are
+# compressed one by one, so they can be decompressed in parallel and found
+# again by offset:
+#
+#   header   MAGIC, version, codec
+#   blocks   the compressed blocks, back to back
+#   index    per block: file offset, stream offset, compressed and raw size
+#   trailer  index offset, block count, MAGIC
+#
+# Before compression a block is laid out as a table of runs (either literal
+# bytes or frames of some packet size), the literal bytes, and for every frame
+# size a matrix of the frame payloads stored byte plane by byte plane, which
+# lines up float exponents and halves the compressed size.
+#
+# oread opens mfcz files as MFCZFile, which reads like the plain stream it
+# was packed from, so every tool takes either.
+
+MAGIC = 'MFCZ'
+VERSION = 1
+HEADER_FMT = '=4sBB'
+INDEX_FMT = '=qqII'
+TRAILER_FMT = '=qI4s'
+CODECS = ['zlib', 'bz2']
+BLOCK_SIZE = 1 << 20
+RUN_FMT = '=II'
+
+def byte_planes(stride):
+    # payload columns reordered so byte b of every float comes before b+1
+    floats = (stride - 1) // 4
+    return np.arange(4 * floats).reshape((floats, 4)).T.ravel()
+
+def packet_size(data, pos):
+    packet_id = ord(data[pos])
+    if PROFILE_PACKET_ID == packet_id:
+        header = struct.calcsize(PROFILE_HEADER_FMT)
+        if pos + header > len(data):
+            return None
+        _, mel_filters, fft_length = struct.unpack_from(PROFILE_HEADER_FMT, data, pos)[:3]
+        return header + 4 * (mel_filters+2 + fft_length)
+    if GROUP_HEADER_PACKET_ID == packet_id:
+        header = struct.calcsize(GROUP_HEADER_FMT)
+        if pos + header > len(data):
+            return None
+        _, filename_len, label_len, _ = struct.unpack_from(GROUP_HEADER_FMT, data, pos)
+        return header + filename_len + label_len
+    return -1
+
+def encode_block(data, stride, final):
+    # lays out the whole packets at the start of data; returns the block, the
+    # number of bytes it covers and the frame size in effect after them
+    runs = []
+    literals = []
+    frames = collections.OrderedDict()
+    view = np.frombuffer(data, dtype=np.uint8)
+    pos = 0
+    while pos < len(data):
+        if FRAME_PACKET_ID == view[pos] and stride:
+            others = np.flatnonzero(view[pos : pos + (len(data) - pos) // stride * stride : stride] != FRAME_PACKET_ID)
+            run = others[0] if len(others) else (len(data) - pos) // stride
+            if 0 == run:
+                break
+            frames.setdefault(stride, []).append(view[pos : pos + run * stride].reshape((run, stride))[:, 1:])
+            runs.append((run, stride))
+            pos += run * stride
+            continue
+
+        size = packet_size(data, pos)
+        if size is None or pos + size > len(data):
+            break
+        if size < 0:
+            # not an mfcc stream after all; keep the rest as it is
+            size = len(data) - pos
+        elif PROFILE_PACKET_ID == view[pos]:
+            mel_filters, fft_length = struct.unpack_from(PROFILE_HEADER_FMT, data, pos)[1:3]
+            stride = 1 + 4 * (mel_filters + fft_length)
+        literals.append(data[pos:pos+size])
+        runs.append((size, 0))
+        pos += size
+
+    if final and pos < len(data):
+        literals.append(data[pos:])
+        runs.append((len(data) - pos, 0))
+        pos = len(data)
+
+    parts = [ struct.pack('=I', len(runs)) ] + [ struct.pack(RUN_FMT, *run) for run in runs ] + literals
+    for size, rows in frames.iteritems():
+        parts.append(np.concatenate(rows)[:, byte_planes(size)].T.tobytes())
+    return ''.join(parts), pos, stride
+
+def decode_block(data):
+    (count,) = struct.unpack_from('=I', data)
+    pos = struct.calcsize('=I')
+    runs = [ struct.unpack_from(RUN_FMT, data, pos + i * struct.calcsize(RUN_FMT)) for i in xrange(count) ]
+    pos += count * struct.calcsize(RUN_FMT)
+
+    literals = data[pos : pos + sum( n for n, stride in runs if 0 == stride )]
+    pos += len(literals)
+
+    frames = collections.OrderedDict()
+    for n, stride in runs:
+        if stride:
+            frames[stride] = frames.get(stride, 0) + n
+    for stride, rows in frames.items():
+        M = np.empty((rows, stride), dtype=np.uint8)
+        M[:, 0] = FRAME_PACKET_ID
+        M[:, 1 + byte_planes(stride)] = np.frombuffer(data, dtype=np.uint8, count=rows * (stride-1), offset=pos).reshape((stride-1, rows)).T
+        pos += rows * (stride-1)
+        frames[stride] = M
+
+    out = []
+    literal = 0
+    done = collections.Counter()
+    for n, stride in runs:
+        if 0 == stride:
+            out.append(literals[literal:literal+n])
+            literal += n
+        else:
+            out.append(frames[stride][done[stride] : done[stride] + n].tobytes())
+            done[stride] += n
+    return ''.join(out)
+
+def compress(codec, data):
+    if 'zlib' == codec:
+        return zlib.compress(data, 6)
+    return bz2.compress(data, 9)
+
+def decompress(codec, data):
+    if 'zlib' == codec:
+        return decode_block(zlib.decompress(data))
+    return decode_block(bz2.decompress(data))
+
+class MFCZFile(object):
+    # keeps up to `threads` blocks ahead of the read position decompressing
+    # in a thread pool, and the last few decompressed blocks for seeks back
+    def __init__(self, f, threads=None, cache=4):
+        self.name = getattr(f, 'name', '?')
+        self._f = f
+
+        header = f.read(struct.calcsize(HEADER_FMT))
+        magic, version, codec = struct.unpack(HEADER_FMT, header)
+        if magic != MAGIC:
+            raise ValueError('%s is not an mfcz file' % self.name)
+        if version != VERSION:
+            raise ValueError('%s is an mfcz version %d file, expected %d' % (self.name, version, VERSION))
+        self.codec = CODECS[codec]
+
+        f.seek(-struct.calcsize(TRAILER_FMT), 2)
+        index_offset, blocks, magic = struct.unpack(TRAILER_FMT, f.read(struct.calcsize(TRAILER_FMT)))
+        if magic != MAGIC:
+            raise ValueError('%s is truncated' % self.name)
+        f.seek(index_offset)
+        size = struct.calcsize(INDEX_FMT)
+        data = f.read(blocks * size)
+        self._blocks = [ struct.unpack_from(INDEX_FMT, data, i * size) for i in xrange(blocks) ]
+        self._starts = [ b[1] for b in self._blocks ]
+        self.size = self._blocks[-1][1] + self._blocks[-1][3] if blocks else 0
+
+        self._threads = threads or multiprocessing.cpu_count()
+        self._pool = None
+        self._pending = dict()
+        self._decoded = collections.OrderedDict()
+        self._cache = cache
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._f.close()
+
+    def _start(self, i):
+        if i >= len(self._blocks) or i in self._pending or i in self._decoded:
+            return
+        offset, _, compressed, _ = self._blocks[i]
+        self._f.seek(offset)
+        data = self._f.read(compressed)
+        if self._pool is None:
+            self._pool = multiprocessing.pool.ThreadPool(self._threads)
+        self._pending[i] = self._pool.apply_async(decompress, (self.codec, data))
+
+    def _block(self, i):
+        if i in self._decoded:
+            data = self._decoded.pop(i)
+        elif self._threads > 1:
+            self._start(i)
+            data = self._pending.pop(i).get()
+        else:
+            offset, _, compressed, _ = self._blocks[i]
+            self._f.seek(offset)
+            data = decompress(self.codec, self._f.read(compressed))
+        self._decoded[i] = data
+        if len(self._decoded) > self._cache:
+            self._decoded.popitem(last=False)
+
+        if self._threads > 1:
+            # work started for some other position is not waited for
+            for j in self._pending.keys():
+                if not i < j <= i + self._threads:
+                    del self._pending[j]
+            for j in xrange(i+1, i+1 + self._threads):
+                self._start(j)
+        return data
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.size - self._pos
+        parts = []
+        while n > 0 and self._pos < self.size:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            data = self._block(i)
+            k = self._pos - self._starts[i]
+            part = data[k:k+n]
+            parts.append(part)
+            self._pos += len(part)
+            n -= len(part)
+        return ''.join(parts)
+
+    def seek(self, offset, whence=0):
+        if 1 == whence:
+            offset += self._pos
+        elif 2 == whence:
+            offset += self.size
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+def pack(in_file, out_file, codec='zlib', block_size=BLOCK_SIZE, threads=None):
+    threads = threads or multiprocessing.cpu_count()
+    pool = multiprocessing.pool.ThreadPool(threads)
+
+    out_file.write(struct.pack(HEADER_FMT, MAGIC, VERSION, CODECS.index(codec)))
+    offset = struct.calcsize(HEADER_FMT)
+    raw = 0
+    index = []
+    pending = ''
+    stride = 0
+    final = False
+    try:
+        while not final:
+            # a few blocks at a time, so the input is never all in memory
+            blocks = []
+            while len(blocks) < 2 * threads and not final:
+                data = in_file.read(block_size)
+                final = not data
+                pending += data
+                if pending and (final or len(pending) >= block_size):
+                    block, size, stride = encode_block(pending, stride, final)
+                    blocks.append((block, size))
+                    pending = pending[size:]
+            for (block, size), data in zip(blocks, pool.map(lambda x: compress(codec, x[0]), blocks)):
+                out_file.write(data)
+                index.append(struct.pack(INDEX_FMT, offset, raw, len(data), size))
+                offset += len(data)
+                raw += size
+    finally:
+        pool.terminate()
+
+    out_file.write(''.join(index))
+    out_file.write(struct.pack(TRAILER_FMT, offset, len(index), MAGIC))
+    return raw, offset + len(index) * struct.calcsize(INDEX_FMT) + struct.calcsize(TRAILER_FMT)
+
+def main():
+    if len(sys.argv) >= 4 and 'pack' == sys.argv[1] and len(sys.argv) <= 6:
+        codec = sys.argv[4] if len(sys.argv) > 4 else 'zlib'
+        if codec not in CODECS:
+            raise ValueError('unknown codec %s; must be %s' % (codec, ' or '.join(CODECS)))
+        block_size = int(sys.argv[5]) << 10 if len(sys.argv) > 5 else BLOCK_SIZE
+        with oread(sys.argv[2]) as in_file:
+            with owrite(sys.argv[3]) as out_file:
+                raw, packed = pack(in_file, out_file, codec, block_size)
+        sys.stderr.write('packed %d bytes into %d (%.1f%%)\n' % (raw, packed, 100. * packed / max(raw, 1)))
+        return
+
+    if 4 == len(sys.argv) and 'unpack' == sys.argv[1]:
+        with oread(sys.argv[2]) as in_file:
+            with owrite(sys.argv[3]) as out_file:
+                for block in iter(lambda: in_file.read(BLOCK_SIZE), ''):
+                    out_file.write(block)
+        return
+
+    sys.stderr.write('USAGE: mfcz.py pack [input mfcc file] [output mfcz file] [codec: zlib or bz2] [block KiB]\n'
+                     '       mfcz.py unpack [input mfcz file] [output mfcc file]\n')
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,21 @@
 #!./python
-import sys
+import sys, itertools, time, getopt
 import cPickle as pickle
-import numpy as np
-import scipy.optimize
 from common import *
 
 ### ----------------------------------------------------------------------- ###
 
-def prepend_ones(M):
-    return np.vstack(( np.ones(M.shape[1]), M ))
+# far enough above the smallest normal number that gradients never go
+# denormal, which slows BLAS down by an order of magnitude
+PROBABILITY_FLOOR = dict(float32 = 1e-30, float64 = 1e-50)
 
 def softmax(A):
-    def f(col):
-        col = col - col.max()
-        col = np.exp(col)
-        return np.maximum(col / col.sum(), 1e-50)
-    return np.matrix(np.apply_along_axis(f, 0, A))
+    A = np.exp(A - A.max(axis=0))
+    return np.maximum(A / A.sum(axis=0), PROBABILITY_FLOOR[A.dtype.name])
 
 def softmax_crossentropy(C, Y):
     return (
-        (np.multiply(np.log(C), -Y)).sum(), # value
+        (np.log(C) * -Y).sum(dtype=np.float64), # value
         C - Y # derivative
     )
 
@@ -27,145 +23,778 @@ def nnet(Warray, X,Y, justAnswer=False):
     inputs = X.shape[0]
     outputs = Y.shape[0]
     
-    W = np.matrix(Warray.reshape((outputs,inputs+1)))
+    # the optimizer keeps its weights in float64, the products run in the
+    # dtype of X; the bias column is applied separately so X is never copied
+    W = np.asarray(Warray, dtype=X.dtype).reshape((outputs,inputs+1))
 
     L0 = X
-    A1 = W * prepend_ones(L0)
+    A1 = np.dot(W[:, 1:], L0) + W[:, 0:1]
     C = softmax(A1)
     if justAnswer:
         return C
     LOSS, dLOSS_dA1 = softmax_crossentropy(C, Y)
-    #dLOSS_dL0 = (W.T * dLOSS_dA1)[1:,] # strip derivative wrt. constant bias
+    #dLOSS_dL0 = np.dot(W[:, 1:].T, dLOSS_dA1)
 
-    dLOSS_dW = dLOSS_dA1 * prepend_ones(L0).T
+    dLOSS_dW = np.hstack(( dLOSS_dA1.sum(axis=1)[:, np.newaxis], np.dot(dLOSS_dA1, L0.T) ))
 
     print LOSS
-    return LOSS, np.array(dLOSS_dW).ravel()
+    return LOSS, dLOSS_dW.ravel().astype(np.float64)
 
 ### ----------------------------------------------------------------------- ###
 
-def run_classifier(X,Y,W):
-    dummyY = np.zeros(Y.shape)
-
-    C = nnet(W, X, dummyY, justAnswer=True)
-    return map(int, np.apply_along_axis(np.argmax, 0, C))
+def dequantize(model):
+    # numpy's integer products don't go through BLAS and ran at half the
+    # float model's speed, so the int8/int16 weights only keep files small:
+    # they are turned back into one float32 matrix once per loaded model, with
+    # the input scales folded back out, and kept next to them
+    if '_weights' not in model:
+        outputs = len(model['labelnames'])
+        Wq = model['qweights'].reshape((outputs, -1))
+        model['_weights'] = (Wq * (model['wscales'][:, np.newaxis] / model['inscales'][np.newaxis, :])) \
+                            .astype(np.float32)
+    return model['_weights']
+
+def quantized_answer(model, X):
+    A = np.dot(dequantize(model), X)
+    return softmax((A + model['bias'][:, np.newaxis]).astype(X.dtype))
+
+def knn_answer(model, X):
+    outputs = len(model['labelnames'])
+    # cKDTree pads missing neighbours with index n; models saved before
+    # knn_model clamped k may still ask for more
+    k = min(model['k'], model['tree'].n)
+
+    _, idx = model['tree'].query(X.T, k)
+    votes = model['labels'][idx.reshape((len(idx), -1))]
+
+    C = np.zeros((outputs, len(votes)), dtype=X.dtype)
+    cols = np.arange(len(votes))
+    for j in xrange(votes.shape[1]):
+        C[votes[:, j], cols] += 1.
+    return np.maximum(C / k, PROBABILITY_FLOOR[C.dtype.name])
+
+def model_answer(model, X):
+    if 'quantized' == model.get('kind'):
+        return quantized_answer(model, X)
+    if 'knn' == model.get('kind'):
+        return knn_answer(model, X)
+    dummyY = np.zeros((len(model['labelnames']), 0))
+    return nnet(model['weights'], X, dummyY, justAnswer=True)
+
+def classify_chunks(X,Y,model, chunk=4096):
+    for start in xrange(0, X.shape[1], chunk):
+        C = model_answer(model, X[:, start:start+chunk])
+        yield Y[:, start:start+chunk], C
+
+def run_classifier(X,Y,model):
+    return [ int(a) for _, C in classify_chunks(X,Y,model) for a in C.argmax(axis=0) ]
+
+def check_classifier(X,Y,model, topk=1):
+    outputs = Y.shape[0]
+    histo = np.zeros(outputs*outputs, dtype=np.int64)
+    loss = np.zeros(outputs)
+    tophits = 0
+
+    for Ychunk, C in classify_chunks(X,Y,model):
+        corr = Ychunk.argmax(axis=0)
+        ans = C.argmax(axis=0)
+        histo += np.bincount(corr * outputs + ans, minlength=outputs*outputs)
+
+        p = C[corr, np.arange(len(corr))]
+        loss += np.bincount(corr, weights=-np.log(p), minlength=outputs)
+
+        if topk > 1:
+            # the true label is in the top k iff fewer than k labels beat it
+            tophits += int(((C > p).sum(axis=0) < topk).sum())
+
+    histo = histo.reshape((outputs, outputs))
+    total = int(histo.sum())
+    errcnt = total - int(np.trace(histo))
+    if topk <= 1:
+        tophits = total - errcnt
+    loss /= np.maximum(histo.sum(axis=1), 1)
+
+    return total, errcnt, histo, tophits, loss
+
+def votes(C):
+    V = np.zeros(C.shape, dtype=C.dtype)
+    V[C.argmax(axis=0), np.arange(C.shape[1])] = 1.
+    return V
+
+def group_sums(V, groups):
+    # column sums of V over the frames of every group number, with the
+    # numbers and frame counts; the frames of a group need not be adjacent
+    order = np.argsort(groups, kind='mergesort')
+    ids, starts, counts = np.unique(groups[order], return_index=True, return_counts=True)
+    return ids, np.add.reduceat(V[:, order], starts, axis=1), counts
+
+def group_decisions(S, counts, how='mean'):
+    # S holds summed log posteriors ('mean') or votes ('vote') per group;
+    # confidence is the normalized geometric mean posterior or the vote share
+    # of the decided label
+    if 'vote' == how:
+        P = S / counts
+    else:
+        P = softmax(S / counts)
+    return P.argmax(axis=0), P.max(axis=0)
+
+def check_groups(X,Y,G,model):
+    outputs = Y.shape[0]
+    groups = int(G.max()) + 1 if len(G) else 0
+    S = dict( (how, np.zeros((outputs, groups))) for how in ('mean', 'vote', 'truth') )
+    counts = np.zeros(groups, dtype=np.int64)
+
+    start = 0
+    for Ychunk, C in classify_chunks(X,Y,model):
+        g = G[start:start+C.shape[1]]
+        start += C.shape[1]
+        for how, V in (('mean', np.log(C)), ('vote', votes(C)), ('truth', Ychunk)):
+            ids, sums, n = group_sums(V, g)
+            S[how][:, ids] += sums
+        counts[ids] += n
+
+    present = counts > 0
+    truth = S['truth'][:, present].argmax(axis=0)
+    hits = dict( (how, int((group_decisions(S[how][:, present], counts[present], how)[0] == truth).sum()))
+                 for how in ('mean', 'vote') )
+    return int(present.sum()), hits
 
-def check_classifier(X,Y,W):
-    ans = run_classifier(X,Y,W)
+### ----------------------------------------------------------------------- ###
 
-    histo = dict([ ((i,j),0) for i in xrange(Y.shape[0]) for j in xrange(Y.shape[0]) ])
-    errcnt = 0
+MODEL_FORMAT = 'nnets-model'
+MODEL_VERSION = 2
+
+def load_model(filename, dtype=DTYPE):
+    with open(filename, 'rb') as f:
+        if f.read(2) != 'PK':
+            f.seek(0)
+            model = pickle.load(f)
+            if 'weights' in model:
+                model['weights'] = np.asarray(model['weights'], dtype=dtype)
+            return model
+
+        f.seek(0)
+        data = np.load(f)
+        if str(data['format']) != MODEL_FORMAT:
+            raise ValueError('%s is not a model file' % filename)
+        if int(data['version']) > MODEL_VERSION:
+            raise ValueError('model file %s has version %d; this nnet.py reads up to %d' % (
+                filename, int(data['version']), MODEL_VERSION))
+
+        model = dict(kind = 'softmax')
+        for key in data.files:
+            value = data[key]
+            if 0 == value.ndim and value.dtype.kind in 'SU':
+                value = str(value)
+            model[key] = value
+        model['labelnames'] = map(str, model['labelnames'])
+        if 'weights' in model:
+            model['weights'] = np.asarray(model['weights'], dtype=dtype)
+        del model['format'], model['version']
+        if 'quantized' == model['kind']:
+            dequantize(model)
+        return model
+
+def save_model(filename, model):
+    # underscored fields are derived at run time
+    fields = dict( (k, v) for k, v in model.iteritems() if not k.startswith('_') )
+    fields['labelnames'] = np.array(fields['labelnames'])
+    with open(filename, 'wb') as f:
+        np.savez(f, format = MODEL_FORMAT, version = MODEL_VERSION, **fields)
+
+def load_dataset(filename, dtype=DTYPE):
+    # older datasets hold np.matrix objects
+    with open(filename, 'rb') as f:
+        dataset = pickle.load(f)
+    dataset['X'] = np.asarray(dataset['X'], dtype=dtype)
+    dataset['Y'] = np.asarray(dataset['Y'], dtype=dtype)
+    return dataset
+
+def knn_model(X, Y, mode, labelnames, k=5):
+    from scipy.spatial import cKDTree
+    return dict(
+        kind = 'knn',
+        tree = cKDTree(np.asarray(X, dtype=np.float64).T),
+        labels = Y.argmax(axis=0).astype(np.int32),
+        k = min(k, X.shape[1]),
+        labelnames = labelnames,
+        mode = mode)
+
+def compile_model(W, mode, labelnames, mel_filters):
+    outputs = len(labelnames)
+    W = np.asarray(W).reshape((outputs, -1))
+    M = feature_matrix(mode, mel_filters)
+
+    # W * [1; M.T * mels] == [W[:,0], W[:,1:] * M.T] * [1; mels]
+    Wc = np.hstack(( W[:, 0:1], np.dot(W[:, 1:], M.T) ))
+
+    return dict(
+        weights = Wc.astype(DTYPE).ravel(),
+        labelnames = labelnames,
+        mode = 'mels',
+        source_mode = mode)
+
+def quantize_model(W, mode, labelnames, X, bits=8):
+    outputs = len(labelnames)
+    W = np.asarray(W, dtype=np.float64).reshape((outputs, -1))
+
+    # inputs are scaled to int16 steps with one scale per feature, calibrated on X;
+    # those scales are folded into the weights before quantizing them
+    # with one scale per output
+    inscales = np.abs(X).max(axis=1) / 32767.
+    inscales[0 == inscales] = 1.
+    Wf = W[:, 1:] * inscales
+
+    top = 2**(bits-1) - 1
+    wscales = np.abs(Wf).max(axis=1) / top
+    wscales[0 == wscales] = 1.
+    Wq = np.clip(np.rint(Wf / wscales[:, np.newaxis]), -top, top)
+
+    return dict(
+        kind = 'quantized',
+        qweights = Wq.astype(np.int8 if bits <= 8 else np.int16).ravel(),
+        wscales = wscales.astype(np.float32),
+        inscales = inscales.astype(np.float32),
+        bias = W[:, 0].astype(np.float32),
+        labelnames = labelnames,
+        mode = mode,
+        source_mode = mode)
 
-    for i in xrange(Y.shape[1]):
-        a = ans[i]
-        corr = np.argmax(Y[:,i])
-        histo[(corr,a)] += 1
-        if a != corr:
-            errcnt += 1
+### ----------------------------------------------------------------------- ###
 
-    return Y.shape[1], errcnt, histo
+# frames classified at once per group when deciding groups, and with a
+# confidence threshold also how often the decision is checked
+GROUP_STEP = 16
+
+class GroupDecider(object):
+    # reduces the posteriors of a group to one decision, classifying its
+    # frames in batches; with a threshold, the rest of a group is not even
+    # looked at once its decision is that confident
+    __slots__ = ('model', 'how', 'threshold', 'step', 'window', 'header', 'pending', 'S', 'n', 'skipped', 'settled')
+
+    def __init__(self, model, how, threshold=None):
+        self.model = model
+        self.how = how
+        self.threshold = threshold
+        self.step = 4096 if threshold is None else GROUP_STEP
+        self.window = ContextWindow(model['mode'])
+        self.start(None)
+
+    def start(self, header):
+        self.header = header
+        self.pending = []
+        self.S = np.zeros(len(self.model['labelnames']))
+        self.n = 0
+        self.skipped = 0
+        self.settled = False
+
+    def push(self, frame):
+        if self.settled:
+            self.skipped += 1
+            return
+        self.pending.extend( x for _, x in self.window.push(frame) )
+        if len(self.pending) >= self.step:
+            self.score()
+
+    def score(self):
+        if not self.pending:
+            return
+        C = model_answer(self.model, np.array(self.pending).T)
+        self.pending = []
+        self.S += (np.log(C) if 'mean' == self.how else votes(C)).sum(axis=1)
+        self.n += C.shape[1]
+        if self.threshold is not None:
+            self.settled = self.decision()[1] >= self.threshold
+
+    def decision(self):
+        decision, confidence = group_decisions(self.S[:, np.newaxis], self.n, self.how)
+        return int(decision[0]), float(confidence[0])
+
+    def finish(self):
+        # the decision on the group so far, None if it had no frames
+        if not self.settled:
+            self.pending.extend( x for _, x in self.window.flush() )
+            self.score()
+        self.window.flush()
+        return self.decision() if self.n else None
+
+def recognize_groups(reader, model, how, threshold):
+    labelnames = model['labelnames']
+    decider = GroupDecider(model, how, threshold)
+    groups = known = hits = frames = skipped = 0
+
+    print '\t'.join([ 'file', 'offset', 'label', 'decision', 'confidence', 'frames', 'skipped' ])
+    # None marks the end of the input
+    for packet in itertools.chain(reader, [None]):
+        if packet is not None and not isinstance(packet, FramePacket):
+            continue
 
-### ----------------------------------------------------------------------- ###
+        if packet is None or packet.group_header is not decider.header:
+            header = decider.header
+            result = decider.finish()
+            if result is not None:
+                decision, confidence = result
+                print '\t'.join([ header.filename, str(header.sample_offset), header.label,
+                                  labelnames[decision], '%.4f' % confidence, str(decider.n), str(decider.skipped) ])
+                sys.stdout.flush()
+                groups += 1
+                frames += decider.n
+                skipped += decider.skipped
+                if header.label in labelnames:
+                    known += 1
+                    hits += int(labelnames[decision] == header.label)
+            if packet is None:
+                break
+            decider.start(packet.group_header)
+
+        decider.push(packet)
+
+    sys.stderr.write('decided %d groups, %d of %d with known labels right; classified %d frames, skipped %d\n' % (
+        groups, hits, known, frames, skipped))
 
 def recognize():
-    if len(sys.argv) != 4:
-        sys.stderr.write('USAGE: nnet.py recognize [mfcc file] [weights file]\n')
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], 'g:t:')
+    except getopt.GetoptError:
+        args = []
+    if len(args) != 2:
+        sys.stderr.write('USAGE: nnet.py recognize [-g mean or vote] [-t confidence] [mfcc or wav file, or shm:ring] [weights or model file]\n')
         sys.exit(1)
-
-    mfcc_file = oread(sys.argv[2])
-    reader = MFCCReader(mfcc_file)
-
-    with open(sys.argv[3], 'rb') as f:
-        W = pickle.load(f)
-        labelnames = W['labelnames']
-        mode = W['mode']
-        W = W['weights']
-
-    makeX = xmaker(mode)
-
-    Y = np.matrix(np.zeros(len(labelnames))).T
+    opts = dict(opts)
+
+    # -g prints one decision per group header instead of every frame's
+    # posteriors; -t stops classifying a group once it is that confident
+    how = opts.get('-g', 'mean' if '-t' in opts else None)
+    if how not in (None, 'mean', 'vote'):
+        raise ValueError('unknown group decision %s; must be mean or vote' % how)
+    threshold = float(opts['-t']) if '-t' in opts else None
+
+    if args[0].endswith('.wav'):
+        from frontend import WaveReader
+        reader = WaveReader(args[0])
+    elif args[0].startswith('shm:'):
+        from shmring import ShmReader
+        reader = ShmReader(args[0][4:])
+    else:
+        reader = MFCCReader(oread(args[0]))
+
+    model = load_model(args[1])
+    if how is not None:
+        return recognize_groups(reader, model, how, threshold)
+
+    labelnames = model['labelnames']
+    window = ContextWindow(model['mode'])
+
+    def answer(ready):
+        for frame, x in ready:
+            C = model_answer(model, x[:, np.newaxis])[:, 0]
+            C = [ str(float(c)) for c in C ]
+            print '\t'.join(C)
 
     for packet in reader:
+        if isinstance(packet, FramePacket):
+            answer(window.push(packet))
+            continue
+
+        answer(window.flush())
         if isinstance(packet, ProfilePacket):
             print '\t'.join(labelnames)
-            continue
         if isinstance(packet, GroupHeaderPacket):
             print '# label %s (file %s, offset %d)' % (packet.label, packet.filename, packet.sample_offset)
-            continue
-
-        X = np.matrix(makeX(packet)).T
 
-        C = nnet(W, X, Y, justAnswer=True)
-        C = [ str(float(C[i])) for i in xrange(C.shape[0]) ]
-        print '\t'.join(C)
+    answer(window.flush())
+
+def segment_batches(packets, size=4096):
+    # lists of contiguous segments as mel arrays, about size frames at a time,
+    # with the label of every frame (None for clipped ones) and the profile
+    # they all share
+    segments, labels, segment = [], [], []
+    n = 0
+    profile = None
+    for frame in packets:
+        if not isinstance(frame, FramePacket):
+            continue
+        if segment and not continues(segment[-1], frame):
+            segments.append(np.array([ f.mel_powers for f in segment ], dtype=DTYPE))
+            n += len(segment)
+            segment = []
+            if n >= size or frame.group_header.profile is not profile:
+                yield segments, labels, profile
+                segments, labels, n = [], [], 0
+        profile = frame.group_header.profile
+        segment.append(frame)
+        labels.append(None if is_clipped(frame) else frame.group_header.label)
+
+    if segment:
+        segments.append(np.array([ f.mel_powers for f in segment ], dtype=DTYPE))
+    if segments:
+        yield segments, labels, profile
+
+class SharedFeatures(object):
+    # every base mode is computed once per batch, and every context mode once
+    # on top of it, however many models use them
+    def __init__(self, modes):
+        self.modes = sorted(set(modes))
+        self.makers = dict( (base, batch_xmaker(base)) for base in set( parse_mode(m)[0] for m in self.modes ) )
+
+    def __call__(self, segments, profile=None):
+        mels = np.concatenate(segments)
+        bases = dict( (base, makeX(mels, profile)) for base, makeX in self.makers.iteritems() )
+        bounds = np.cumsum([0] + map(len, segments))
+
+        features = dict()
+        for mode in self.modes:
+            base, width, order = parse_mode(mode)
+            if 0 == width + order:
+                features[mode] = bases[base]
+                continue
+            pad = context_pad(width, order)
+            features[mode] = np.concatenate([
+                stack_context(delta_rows(pad_rows(bases[base][lo:hi], pad), order), width)
+                for lo, hi in zip(bounds[:-1], bounds[1:]) ])
+        return features
+
+def score():
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], 'eo:')
+    except getopt.GetoptError:
+        args = []
+    if len(args) < 2:
+        sys.stderr.write('USAGE: nnet.py score [-e] [-o posteriors npz] [mfcc file] [weights or model files...]\n')
+        sys.exit(1)
+    opts = dict(opts)
+
+    names = args[1:]
+    models = [ load_model(x) for x in names ]
+    ensemble = '-e' in opts
+    if ensemble:
+        if any( m['labelnames'] != models[0]['labelnames'] for m in models ):
+            raise ValueError('cannot average models with different label names')
+        names.append('ensemble')
+
+    features = SharedFeatures([ m['mode'] for m in models ])
+    labelnums = [ dict( (x,i) for (i,x) in enumerate(m['labelnames']) ) for m in models ]
+    if ensemble:
+        labelnums.append(labelnums[0])
+
+    frames = 0
+    hits = np.zeros(len(names), dtype=np.int64)
+    scored = np.zeros(len(names), dtype=np.int64)
+    spent = np.zeros(len(names) + 1)
+    posteriors = [ [] for x in names ]
+    truth = []
+
+    start = time.time()
+    with oread(args[0]) as in_file:
+        for segments, labels, profile in segment_batches(MFCCReader(in_file, readahead=4)):
+            frames += len(labels)
+
+            t = time.time()
+            X = features(segments, profile)
+            spent[-1] += time.time() - t
+
+            answers = []
+            for i, model in enumerate(models):
+                t = time.time()
+                answers.append(model_answer(model, X[model['mode']].T))
+                spent[i] += time.time() - t
+            if ensemble:
+                answers.append(sum(answers) / len(models))
+
+            for i, C in enumerate(answers):
+                y = np.array([ labelnums[i].get(x, -1) for x in labels ])
+                known = y >= 0
+                hits[i] += int((C.argmax(axis=0)[known] == y[known]).sum())
+                scored[i] += int(known.sum())
+                if '-o' in opts:
+                    posteriors[i].append(C.T)
+            truth.extend(labels)
+    elapsed = time.time() - start
+
+    print '%-24s %-12s %8s %9s %8s' % ('model', 'mode', 'frames', 'accuracy', 'time')
+    for i, name in enumerate(names):
+        mode = models[i]['mode'] if i < len(models) else '-'
+        print '%-24s %-12s %8d %8.1f%% %7.2fs' % (name, mode, scored[i], 100.*hits[i]/max(scored[i], 1), spent[i])
+    print 'scored %d frames with %d models in one pass: %.2fs, %.2fs of it computing %d feature modes' % (
+        frames, len(models), elapsed, spent[-1], len(features.modes))
+
+    if '-o' in opts:
+        with open(opts['-o'], 'wb') as f:
+            np.savez(f,
+                models = np.array(names),
+                labels = np.array([ x or '' for x in truth ]),
+                **dict( ('posteriors%d' % i, np.concatenate(p) if p else np.zeros((0, 0), dtype=DTYPE))
+                        for i, p in enumerate(posteriors) ))
+        print 'dumped posteriors to %s' % opts['-o']
+
+def check_compatible(dataset, model):
+    if model['mode'] != dataset['mode'] and model.get('source_mode') == dataset['mode']:
+        raise ValueError('model was compiled from %s weights to take mel powers; '
+                         'test it on a mels test file, or test the %s weights' % (dataset['mode'], dataset['mode']))
+    if model['mode'] != dataset['mode']:
+        raise ValueError('mode mismatch; test file has %s, but nnet file has %s' % (dataset['mode'], model['mode']))
+    # models learnt with generated silence have a sil output test sets lack
+    if model['labelnames'] == sorted(dataset['labelnames'] + ['sil']):
+        add_label(dataset, 'sil')
+    if model['labelnames'] != dataset['labelnames']:
+        raise ValueError('label names mismatch')
 
 def test():
-    if len(sys.argv) != 4:
-        sys.stderr.write('USAGE: nnet.py test [test file] [weights file]\n')
+    if len(sys.argv) not in (4,5):
+        sys.stderr.write('USAGE: nnet.py test [test file] [weights file] [top-k]\n')
         sys.exit(1)
 
-    with open(sys.argv[2], 'rb') as f:
-        test = pickle.load(f)
-        mode = test['mode']
-        X = test['X']
-        Y = test['Y']
-        labelnames = test['labelnames']
-
-    with open(sys.argv[3], 'rb') as f:
-        W = pickle.load(f)
-        if W['mode'] != mode:
-            raise ValueError('mode mismatch; test file has %s, but nnet file has %s' % (mode, W['mode']))
-        if W['labelnames'] != labelnames:
-            raise ValueError('label names mismatch')
-        W = W['weights']
-
-    total, errcnt, histo = check_classifier(X,Y,W)
+    topk = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    test = load_dataset(sys.argv[2])
+    model = load_model(sys.argv[3])
+    check_compatible(test, model)
+    X = test['X']
+    Y = test['Y']
+    labelnames = test['labelnames']
+
+    start = time.time()
+    total, errcnt, histo, tophits, loss = check_classifier(X,Y,model, topk)
+    elapsed = time.time() - start
     print 'made %d errors out of %d; accuracy %.1f%%' % (errcnt, total, 100. - 100.*errcnt/total)
+    if topk > 1:
+        print 'top-%d accuracy %.1f%%' % (topk, 100.*tophits/total)
+    print 'classified %d frames in %.2fs (%.0f frames/s)' % (total, elapsed, total / max(elapsed, 1e-9))
+    if 'G' in test:
+        groups, hits = check_groups(X,Y,test['G'],model)
+        print 'group accuracy over %d groups: %.1f%% by mean log-probability, %.1f%% by majority vote' % (
+            groups, 100.*hits['mean']/max(groups, 1), 100.*hits['vote']/max(groups, 1))
 
     for label in labelnames:
         sys.stdout.write('\t' + label)
-    print
+    print '\t\tlog-loss'
     for i,label in enumerate(labelnames):
         sys.stdout.write(label)
-        total = errcnt = 0
         for j in xrange(len(labelnames)):
-            sys.stdout.write('\t%d' % histo[(i,j)] )
-            total += histo[(i,j)]
-            if i != j:
-                errcnt += histo[(i,j)]
-        print '\t(%.1f%%)' % (100. - 100.*errcnt/total)
+            sys.stdout.write('\t%d' % histo[i,j])
+        total = histo[i].sum()
+        errcnt = total - histo[i,i]
+        # like sil, which only training gets frames of
+        if 0 == total:
+            print '\t-\t-'
+            continue
+        print '\t(%.1f%%)\t%.3f' % (100. - 100.*errcnt/total, loss[i])
+
+
+# augmentation settings, as -a silence=1,noise=2,gain=6,copies=1 or -a none:
+# silence adds generated silence frames, as many as the average label has;
+# copies adds that many copies of every frame with gaussian noise of the given
+# deviation on every mel power and the same random shift of up to gain on all
+# of them; all of it happens in feature space and is not stored anywhere
+AUGMENT_DEFAULTS = dict(silence = 1., noise = 0., gain = 0., copies = 1)
+
+def parse_augment(spec):
+    settings = dict(AUGMENT_DEFAULTS)
+    if 'none' == spec:
+        settings.update(silence = 0., copies = 0)
+        return settings
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        if key not in settings:
+            raise ValueError('unknown augmentation %s; must be one of %s' % (key, ', '.join(sorted(settings))))
+        settings[key] = type(settings[key])(value)
+    return settings
+
+def add_label(dataset, name):
+    # an output without samples, in sorted place
+    labelnames = sorted(dataset['labelnames'] + [name])
+    i = labelnames.index(name)
+    Y = dataset['Y']
+    dataset['Y'] = np.vstack(( Y[:i], np.zeros((1, Y.shape[1]), dtype=Y.dtype), Y[i:] ))
+    dataset['labelnames'] = labelnames
+
+def augment(X, Y, training, settings, chunk=4096):
+    labelnames = training['labelnames']
+    mel_filters = training.get('mel_filters')
+    if mel_filters is None:
+        sys.stderr.write('not augmenting: %s has no mel filter count, rerun pre-nnet.py\n' % training['mode'])
+        return X, Y
+
+    L = window_matrix(training['mode'], mel_filters)
+    Xs = [X]
+    Ys = [Y]
+
+    perturbed = settings['noise'] > 0 or settings['gain'] > 0
+    for c in xrange(settings['copies'] if perturbed else 0):
+        for start in xrange(0, X.shape[1], chunk):
+            n = min(chunk, X.shape[1] - start)
+            D = np.random.normal(0., settings['noise'], (n, L.shape[0])) if settings['noise'] > 0 else \
+                np.zeros((n, L.shape[0]))
+            D += np.random.uniform(-settings['gain'], settings['gain'], (n, 1))
+            Xs.append(X[:, start:start+n] + np.dot(D, L).T.astype(X.dtype))
+            Ys.append(Y[:, start:start+n])
+
+    counts = Y.sum(axis=1)
+    rep = int(settings['silence'] * counts.sum() / max((counts > 0).sum(), 1))
+    if rep and 'sil' in labelnames:
+        silence = training['mel_power_threshold']
+        mels = np.random.uniform(silence, silence + 10., (rep, L.shape[0]))
+        Xs.append(np.dot(mels, L).T.astype(X.dtype))
+        S = np.zeros((len(labelnames), rep), dtype=Y.dtype)
+        S[labelnames.index('sil')] = 1.
+        Ys.append(S)
+
+    print 'augmented %d samples to %d' % (X.shape[1], sum( x.shape[1] for x in Xs ))
+    return np.hstack(Xs), np.hstack(Ys)
+
+
+def verify():
+    if len(sys.argv) != 4:
+        sys.stderr.write('USAGE: nnet.py verify [test file] [weights or model file]\n')
+        sys.exit(1)
 
+    # classifies the test set in float64 and in float32 and fails if the two
+    # disagree on accuracy
+    test = load_dataset(sys.argv[2], 'float64')
+    model = load_model(sys.argv[3], 'float64')
+    check_compatible(test, model)
+    correct = test['Y'].argmax(axis=0)
+
+    answers = dict()
+    accuracy = dict()
+    for dtype in ('float64', 'float32'):
+        X = test['X'].astype(dtype)
+        Y = test['Y'].astype(dtype)
+        m = dict(model)
+        if 'weights' in m:
+            m['weights'] = m['weights'].astype(dtype)
+
+        start = time.time()
+        answers[dtype] = np.concatenate([ C.argmax(axis=0) for _, C in classify_chunks(X,Y,m) ])
+        elapsed = time.time() - start
+        accuracy[dtype] = 100. * (answers[dtype] == correct).mean()
+        print '%s: accuracy %.2f%%, features take %d bytes, classified in %.3fs' % (
+            dtype, accuracy[dtype], X.nbytes, elapsed)
+
+    print 'answers agree on %.2f%% of %d frames' % (
+        100. * (answers['float64'] == answers['float32']).mean(), len(correct))
+    if abs(accuracy['float64'] - accuracy['float32']) > .1:
+        sys.stderr.write('float32 accuracy differs from float64 by more than 0.1 points\n')
+        sys.exit(1)
 
 def learn():
-    if len(sys.argv) != 4:
-        sys.stderr.write('USAGE: nnet.py learn [training file] [output weights file]\n')
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], 'a:')
+    except getopt.GetoptError:
+        args = []
+    if len(args) not in (2,3):
+        sys.stderr.write('USAGE: nnet.py learn [-a augmentation] [training file] [output weights file] [engine: softmax or knn:K]\n')
         sys.exit(1)
+    opts = dict(opts)
 
-    with open(sys.argv[2], 'rb') as f:
-        training = pickle.load(f)
-    
+    engine, _, k = (args[2] if len(args) > 2 else 'softmax').partition(':')
+    if engine not in ('softmax', 'knn'):
+        raise ValueError('unknown engine %s; must be softmax or knn' % engine)
+    settings = parse_augment(opts.get('-a', ''))
+
+    training = load_dataset(args[0])
+
+    seed_random()
     mode = training['mode']
-    X = training['X']
-    Y = training['Y']
+    if settings['silence'] > 0 and 'sil' not in training['labelnames']:
+        add_label(training, 'sil')
+    X, Y = augment(training['X'], training['Y'], training, settings)
     inputs = X.shape[0]
     outputs = Y.shape[0]
 
+    if 'knn' == engine:
+        start = time.time()
+        model = knn_model(X, Y, mode, training['labelnames'], int(k or 5))
+        print 'built k-d tree over %d frames of %d features in %.2fs' % (X.shape[1], inputs, time.time() - start)
+        with open(args[1], 'wb') as f:
+            pickle.dump(model, f, -1)
+        print 'dumped %d-nn model to %s' % (model['k'], args[1])
+        return
+
     W = np.random.rand(outputs*(inputs+1))
     W = W * 0.6 - 0.3
 
+    import scipy.optimize
     W, value, info = scipy.optimize.fmin_l_bfgs_b(nnet, W, args=(X,Y), factr=1e10)
     print 'loss: %f' % value
     print 'weights:\n%r' % W
     print 'notes:\n%r' % info
     print
 
-    with open(sys.argv[3], 'wb') as f:
+    with open(args[1], 'wb') as f:
         pickle.dump(dict(
-            weights = W,
+            weights = W.astype(DTYPE),
             labelnames = training['labelnames'],
-            mode = mode),
+            mode = mode,
+            mel_filters = training.get('mel_filters')),
             f, -1)
-    print 'dumped weights to %s' % sys.argv[3]
+    print 'dumped weights to %s' % args[1]
+
+def compile_weights():
+    if len(sys.argv) not in (4,5):
+        sys.stderr.write('USAGE: nnet.py compile [weights file] [output model file] [mel filters]\n')
+        sys.exit(1)
+
+    W = load_model(sys.argv[2])
+    # weights learnt since the mel filter count went into datasets know it
+    mel_filters = W.get('mel_filters')
+    if len(sys.argv) > 4:
+        if mel_filters is not None and int(sys.argv[4]) != mel_filters:
+            raise ValueError('%s was learnt on %d mel filters, not %s' % (sys.argv[2], mel_filters, sys.argv[4]))
+        mel_filters = int(sys.argv[4])
+    if mel_filters is None:
+        raise ValueError('%s does not say how many mel filters it was learnt on; give the count' % sys.argv[2])
+
+    if 'softmax' != W.get('kind', 'softmax'):
+        raise ValueError('can only compile softmax weights, %s is a %s model' % (sys.argv[2], W['kind']))
+    if 'mels' == W['mode']:
+        raise ValueError('%s already operates on mel powers' % sys.argv[2])
+    if parse_mode(W['mode'])[0] != W['mode']:
+        raise ValueError('cannot compile context mode %s' % W['mode'])
+
+    model = compile_model(W['weights'], W['mode'], W['labelnames'], mel_filters)
+    save_model(sys.argv[3], model)
+    print 'compiled %s weights for %d mel filters into %s' % (W['mode'], mel_filters, sys.argv[3])
+
+def quantize():
+    if len(sys.argv) not in (5,6):
+        sys.stderr.write('USAGE: nnet.py quantize [weights or model file] [test file] [output model file] [bits]\n')
+        sys.exit(1)
+
+    bits = int(sys.argv[5]) if len(sys.argv) > 5 else 8
+    if bits not in (8, 16):
+        raise ValueError('can only quantize to 8 or 16 bits')
+
+    model = load_model(sys.argv[2])
+    if 'quantized' == model.get('kind'):
+        raise ValueError('%s is already quantized' % sys.argv[2])
+    if 'knn' == model.get('kind'):
+        raise ValueError('%s is a k-nn model and has no weights to quantize' % sys.argv[2])
+
+    test = load_dataset(sys.argv[3])
+    check_compatible(test, model)
+    X = test['X']
+    Y = test['Y']
+
+    qmodel = quantize_model(model['weights'], model['mode'], model['labelnames'], X, bits)
+    qmodel['source_mode'] = model.get('source_mode', model['mode'])
+    save_model(sys.argv[4], qmodel)
+
+    total = agree = errcnt = qerrcnt = 0
+    for (Ychunk, C), (_, Cq) in itertools.izip(classify_chunks(X,Y,model), classify_chunks(X,Y,qmodel)):
+        corr = Ychunk.argmax(axis=0)
+        ans = C.argmax(axis=0)
+        qans = Cq.argmax(axis=0)
+        total += len(corr)
+        agree += int((ans == qans).sum())
+        errcnt += int((ans != corr).sum())
+        qerrcnt += int((qans != corr).sum())
+
+    print 'quantized to %d bits; weights take %d bytes on disk instead of %d' % (
+        bits, qmodel['qweights'].nbytes, np.asarray(model['weights']).nbytes)
+    print 'agreement with float model: %.2f%% of %d frames' % (100.*agree/total, total)
+    print 'accuracy: float %.1f%%, quantized %.1f%%' % (100. - 100.*errcnt/total, 100. - 100.*qerrcnt/total)
+    print 'dumped quantized model to %s' % sys.argv[4]
 
 def main():
     if len(sys.argv) >= 2:
@@ -173,10 +802,18 @@ def main():
             return learn()
         if sys.argv[1] == 'test':
             return test()
+        if sys.argv[1] == 'verify':
+            return verify()
         if sys.argv[1] == 'recognize':
             return recognize()
-
-    sys.stderr.write('USAGE: nnet.py [learn|test|recognize] [options...]\n')
+        if sys.argv[1] == 'score':
+            return score()
+        if sys.argv[1] == 'compile':
+            return compile_weights()
+        if sys.argv[1] == 'quantize':
+            return quantize()
+
+    sys.stderr.write('USAGE: nnet.py [learn|test|verify|recognize|score|compile|quantize] [options...]\n')
     sys.exit(1)
 
 if __name__ == '__main__':
@@ -1,13 +1,17 @@
 #!./python
 
-import sys, itertools
-import numpy as np
+import sys, itertools, getopt
 from common import *
 
 def main():
-    if len(sys.argv) != 2:
-        sys.stderr.write('USAGE: pca.py [input mfcc file]\n')
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 's')
+    except getopt.GetoptError:
+        args = []
+    if len(args) != 1:
+        sys.stderr.write('USAGE: pca.py [-s] [input mfcc file]\n')
         sys.exit(1)
+    opts = dict(opts)
 
     X = [ ]
     labels = { }
@@ -15,7 +19,7 @@ def main():
     print '# loading frames...'
 
     profile = None
-    with oread(sys.argv[1]) as in_file:
+    with oread(args[0]) as in_file:
         for packet in MFCCReader(in_file):
             if isinstance(packet, ProfilePacket):
                 profile = packet
@@ -28,15 +32,18 @@ def main():
                 labels[label].append(len(X))
                 X.append(packet.mel_powers)
     print '# loaded %d frames' % len(X)
+    # -s makes the result the pca basis for streams with this filterbank
+    if '-s' in opts and profile.mel_filters == len(PCA_COEFFS):
+        raise ValueError('the pca basis for %d mel filters is built in' % profile.mel_filters)
 
-    X = np.array(X, dtype=np.float32).T
+    X = np.array(X, dtype=DTYPE).T
     
     subX = []
     s = min(map(len, labels.itervalues()))
     for idcs in labels.itervalues():
         idcs = np.random.choice(idcs, s, replace=False)
         subX.append( X[:, idcs] )
-    X = np.matrix(np.hstack(subX))
+    X = np.hstack(subX)
     del subX
     del labels
 
@@ -46,12 +53,12 @@ def main():
     X -= np.average(X, axis=0)
 
     print '# centering...'
-    X -= np.average(X, axis=1)
+    X -= np.average(X, axis=1)[:, np.newaxis]
 
     print '# computing covariance...'
     m = X.shape[0] # number of dimentions
     n = X.shape[1] # number of samples
-    M = (X * X.T) * (1. / n)
+    M = np.dot(X, X.T) * (1. / n)
 
     print '# computing eigenvalues...'
     L, V = np.linalg.eigh(M)
@@ -71,10 +78,13 @@ def main():
     print
 
     print '# applying volume normalization matrix...'
-    V = (  np.matrix(np.identity(m, dtype=np.float32))
-         - np.matrix(np.ones(m, dtype=np.float32)) * (1. / m)) * V
+    V = np.dot(np.identity(m, dtype=DTYPE) - 1. / m, V)
 
     print repr(V)
+
+    if '-s' in opts:
+        save_transform('pca', V, profile.mel_freqs)
+        print '# saved to %s' % transform_path('pca', m)
     
 if __name__ == '__main__':
     main()
@@ -1,28 +1,127 @@
 #!./python
 
-import sys, itertools, collections
-import numpy as np
+import sys, os, collections, shutil, tempfile
 import cPickle as pickle
 from common import *
 
+# Feature rows go to disk as they are made, CHUNK_ROWS at a time. The shuffle
+# then scatters every chunk row by row over as many bucket files, permutes
+# each bucket in memory and deals its rows out to the shards label by label,
+# so no step holds more than a chunk, a bucket or a shard.
+CHUNK_ROWS = 1 << 16
+
+class RowFile(object):
+    # DTYPE feature rows, int32 label codes and int32 group numbers, appended
+    # to raw files
+    __slots__ = ('path', 'n')
+
+    def __init__(self, path):
+        self.path = path
+        self.n = 0
+
+    def append(self, X, codes, groups):
+        with open(self.path + '.x', 'ab') as f:
+            np.asarray(X, dtype=DTYPE).tofile(f)
+        with open(self.path + '.y', 'ab') as f:
+            np.asarray(codes, dtype=np.int32).tofile(f)
+        with open(self.path + '.g', 'ab') as f:
+            np.asarray(groups, dtype=np.int32).tofile(f)
+        self.n += len(codes)
+
+    def take(self, features):
+        if 0 == self.n:
+            return np.zeros((0, features), dtype=DTYPE), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        X = np.fromfile(self.path + '.x', dtype=DTYPE).reshape((-1, features))
+        codes = np.fromfile(self.path + '.y', dtype=np.int32)
+        groups = np.fromfile(self.path + '.g', dtype=np.int32)
+        for ext in ('.x', '.y', '.g'):
+            os.unlink(self.path + ext)
+        return X, codes, groups
+
+def split_by(where, parts, *arrays):
+    order = np.argsort(where, kind='mergesort')
+    bounds = np.cumsum(np.bincount(where, minlength=parts))
+    return zip(*[ np.split(a[order], bounds[:-1]) for a in arrays ])
+
 class Dataset(object):
-    __slots__ = ('mode', 'makeX', 'profile', 'n', 'X', 'Y', 'labelnames')
+    __slots__ = ('mode', 'makeX', 'width', 'order', 'profile', 'n', 'features', 'labelnames',
+                 'codes', 'names', 'counts', 'keep', 'segment', 'groups', 'header',
+                 'tmpdir', 'pending', 'pending_rows', 'chunks', 'shards')
 
-    def __init__(self, mode):
+    def __init__(self, mode, tmpdir):
         self.mode = mode
-        self.makeX = xmaker(mode)
+        base, self.width, self.order = parse_mode(mode)
+        self.makeX = batch_xmaker(base)
         self.profile = None
         self.n = 0
-        self.X = []
-        self.Y = []
+        self.features = 0
+        self.codes = dict()
+        self.names = []
+        self.counts = collections.Counter()
+        self.keep = dict()
+        self.segment = []
+        self.groups = 0
+        self.header = None
+        self.tmpdir = tmpdir
+        self.pending = []
+        self.pending_rows = 0
+        self.chunks = []
+        self.shards = []
 
     def addFrame(self, frame):
-        if is_clipped(frame):
-            return
+        if self.segment and not continues(self.segment[-1], frame):
+            self.flush()
         self.profile = self.profile or frame.group_header.profile
-        self.X.append(self.makeX(frame))
-        self.Y.append(frame.group_header.label)
-        self.n += 1
+        if frame.group_header is not self.header:
+            self.header = frame.group_header
+            self.groups += 1
+        self.segment.append(frame)
+
+    def flush(self):
+        if not self.segment:
+            return
+        mels = np.array([ f.mel_powers for f in self.segment ], dtype=DTYPE)
+        labels = [ None if is_clipped(f) else f.group_header.label for f in self.segment ]
+        self.add_segment(mels, labels, self.groups - 1, self.segment[0].group_header.profile)
+        self.segment = []
+
+    def add_segment(self, mels, labels, group, profile=None):
+        keep = [ i for (i,label) in enumerate(labels) if label is not None ]
+        if not keep:
+            return
+        block = delta_rows(pad_rows(self.makeX(mels, profile), context_pad(self.width, self.order)), self.order)
+        X = stack_context(block, self.width)[keep]
+        codes = [ self.code(labels[i]) for i in keep ]
+
+        self.features = X.shape[1]
+        self.pending.append((X, codes, [group] * len(codes)))
+        self.pending_rows += len(codes)
+        self.n += len(codes)
+        if self.pending_rows >= CHUNK_ROWS:
+            self.spill()
+
+    def code(self, label):
+        if label not in self.codes:
+            self.codes[label] = len(self.names)
+            self.names.append(label)
+        code = self.codes[label]
+        self.counts[code] += 1
+        return code
+
+    def spill(self):
+        if not self.pending:
+            return
+        chunk = RowFile(os.path.join(self.tmpdir, 'chunk%d' % len(self.chunks)))
+        chunk.append(*[ np.concatenate(parts) for parts in zip(*self.pending) ])
+        self.chunks.append(chunk)
+        self.pending = []
+        self.pending_rows = 0
+
+    def frequencies(self, counts):
+        labelfreq = collections.Counter()
+        for code, count in counts.iteritems():
+            labelfreq[self.names[code]] += count
+        return labelfreq
 
     def equalize(self):
         if 0 == self.n:
@@ -30,95 +129,109 @@ class Dataset(object):
 
         sys.stderr.write('equalizing...\n')
 
-        labelfreq = collections.Counter(self.Y)
+        labelfreq = self.frequencies(self.counts)
         minfreq = min(labelfreq.itervalues())
 
         sys.stderr.write('  total samples: %d\n' % self.n)
         sys.stderr.write('  label frequencies: %r\n' % labelfreq)
         sys.stderr.write('  rarest label has frequency %d\n' % minfreq)
 
+        # rows are only dropped while shuffling
         fraction = .5
-        r = np.random.random(size = self.n)
-        selector = [ r[i] <= fraction * minfreq / labelfreq[self.Y[i]] for i in xrange(self.n) ]
-
-        self.X = [ x for (i,x) in enumerate(self.X) if selector[i] ]
-        self.Y = [ y for (i,y) in enumerate(self.Y) if selector[i] ]
-        self.n = len(self.X)
+        self.keep = dict( (code, fraction * minfreq / labelfreq[self.names[code]]) for code in self.counts )
 
-        sys.stderr.write('  adding silence\n')
-        self.add_silence(int(fraction*minfreq))
-
-        labelfreq = collections.Counter(self.Y)
-
-        sys.stderr.write('  remaining samples: %d\n' % self.n)
-        sys.stderr.write('  adjusted frequencies: %r\n' % labelfreq)
-
-    def add_silence(self, rep):
-        mel_filters = self.profile.mel_filters
-        silence = self.profile.mel_power_threshold
-        noise = 10.
-
-        for i in xrange(rep):
-            mel_powers = list(np.random.uniform(silence, silence+noise, mel_filters))
-
-            packet = FramePacket(
-                seq = 0, group_header = None, fft_powers = [], sample_offset = 0,
-                mel_powers = mel_powers
-            )
-
-            self.X.append(self.makeX(packet))
-            self.Y.append('sil')
-            self.n += 1
-
-    def numpyfy(self, labelnames):
-        sys.stderr.write('numpyfying...\n')
-
-        self.labelnames = labelnames
-        labelnums = dict([ (x,i) for (i,x) in enumerate(labelnames) ])
-
-        self.X = np.matrix(np.vstack(self.X).T)
-
-        Y = np.zeros( (len(labelnames), self.n), dtype=np.float32 )
-        for i, label in enumerate(self.Y):
-            Y[labelnums[label], i] = 1.
-        self.Y = np.matrix(Y)
-
-    def shuffle(self):
+    def shuffle(self, shards=1):
         sys.stderr.write('shuffling...\n')
-        perm = np.random.permutation(self.n)
-        self.X = self.X[:, perm]
-        self.Y = self.Y[:, perm]
+        self.spill()
+
+        self.labelnames = sorted(set(self.names))
+        labelnums = np.array([ self.labelnames.index(x) for x in self.names ], dtype=np.int32)
+        keep = np.array([ self.keep.get(code, 1.) for code in xrange(len(self.names)) ])
+
+        buckets = [ RowFile(os.path.join(self.tmpdir, 'bucket%d' % i)) for i in xrange(max(len(self.chunks), 1)) ]
+        kept = collections.Counter()
+        for chunk in self.chunks:
+            X, codes, groups = chunk.take(self.features)
+            if self.keep:
+                selector = np.random.random(size = len(codes)) <= keep[codes]
+                X, codes, groups = X[selector], codes[selector], groups[selector]
+            kept.update(codes.tolist())
+            where = np.random.randint(len(buckets), size = len(codes))
+            for bucket, parts in zip(buckets, split_by(where, len(buckets), X, codes, groups)):
+                if len(parts[1]):
+                    bucket.append(*parts)
+        self.chunks = []
+        self.n = sum(kept.itervalues())
+
+        if self.keep:
+            sys.stderr.write('  remaining samples: %d\n' % self.n)
+            sys.stderr.write('  adjusted frequencies: %r\n' % self.frequencies(kept))
+
+        # every label is dealt round-robin, so shards differ by at most one
+        # row per label
+        self.shards = [ RowFile(os.path.join(self.tmpdir, 'shard%d' % i)) for i in xrange(shards) ]
+        dealt = np.zeros(len(self.labelnames), dtype=np.int64)
+        for bucket in buckets:
+            X, codes, groups = bucket.take(self.features)
+            perm = np.random.permutation(len(codes))
+            X, Y, G = X[perm], labelnums[codes[perm]], groups[perm]
+
+            where = np.zeros(len(Y), dtype=np.int64)
+            for label in np.unique(Y):
+                rows = np.flatnonzero(Y == label)
+                where[rows] = (dealt[label] + np.arange(len(rows))) % shards
+                dealt[label] += len(rows)
+            for shard, parts in zip(self.shards, split_by(where, shards, X, Y, G)):
+                if len(parts[1]):
+                    shard.append(*parts)
 
     def dump(self, filename):
-        sys.stderr.write('dumping to %s...\n' % filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(dict(
-                mode = self.mode,
-                X = self.X,
-                Y = self.Y,
-                labelnames = self.labelnames),
-                f, -1)
+        for i, shard in enumerate(self.shards):
+            if len(self.shards) > 1:
+                root, ext = os.path.splitext(filename)
+                name = '%s.%d%s' % (root, i, ext)
+            else:
+                name = filename
+            sys.stderr.write('dumping %d samples to %s...\n' % (shard.n, name))
+
+            X, labels, groups = shard.take(self.features)
+            Y = np.zeros( (len(self.labelnames), len(labels)), dtype=DTYPE )
+            Y[labels, np.arange(len(labels))] = 1.
+
+            with open(name, 'wb') as f:
+                pickle.dump(dict(
+                    mode = self.mode,
+                    X = X.T,
+                    Y = Y,
+                    G = groups,
+                    labelnames = self.labelnames,
+                    mel_filters = self.profile.mel_filters if self.profile else None,
+                    mel_power_threshold = self.profile.mel_power_threshold if self.profile else None),
+                    f, -1)
 
 def main():
-    if len(sys.argv) != 4:
-        sys.stderr.write('USAGE: pre-nnet.py [mode] [output pickle file] [input mfcc file]\n')
+    if len(sys.argv) not in (4,5):
+        sys.stderr.write('USAGE: pre-nnet.py [mode] [output pickle file] [input mfcc file] [shards]\n')
         sys.exit(1)
 
-    dataset = Dataset(sys.argv[1])
-
-    with oread(sys.argv[3]) as in_file:
-        for packet in MFCCReader(in_file):
-            if isinstance(packet, FramePacket):
-                dataset.addFrame(packet)
+    shards = int(sys.argv[4]) if len(sys.argv) > 4 else 1
 
-    dataset.equalize()
+    seed_random()
+    tmpdir = tempfile.mkdtemp(prefix='pre-nnet-', dir=os.path.dirname(os.path.abspath(sys.argv[2])))
+    try:
+        dataset = Dataset(sys.argv[1], tmpdir)
 
-    labelnames = sorted(set(dataset.Y))
+        with oread(sys.argv[3]) as in_file:
+            for packet in MFCCReader(in_file):
+                if isinstance(packet, FramePacket):
+                    dataset.addFrame(packet)
+        dataset.flush()
 
-    dataset.numpyfy(labelnames)
-    dataset.shuffle()
-    dataset.dump(sys.argv[2])
+        dataset.equalize()
+        dataset.shuffle(shards)
+        dataset.dump(sys.argv[2])
+    finally:
+        shutil.rmtree(tmpdir)
 
 if __name__ == '__main__':
     main()
-
@@ -1,41 +1,87 @@
 #!./python 
 
 import sys
-import numpy as np
 from common import *
 
+class Reservoir(object):
+    __slots__ = ('data', 'seen')
+
+    def __init__(self, size, dims):
+        self.data = np.empty((size, dims), dtype=np.float32)
+        self.seen = 0
+
+    def add(self, X):
+        size = self.data.shape[0]
+        fill = min(max(size - self.seen, 0), X.shape[0])
+        self.data[self.seen:self.seen+fill] = X[:fill]
+
+        rest = X[fill:]
+        if len(rest):
+            # item number t replaces a random slot with probability size/(t+1)
+            t = self.seen + fill + np.arange(len(rest))
+            slots = (np.random.random(len(rest)) * (t + 1)).astype(np.int64)
+            keep = slots < size
+            self.data[slots[keep]] = rest[keep]
+
+        self.seen += X.shape[0]
+
+    def sample(self, n):
+        count = min(self.seen, self.data.shape[0])
+        return self.data[np.random.permutation(count)[:n]]
+
+def label_batches(reader, size=4096):
+    label = None
+    batch = []
+    for packet in reader:
+        if not isinstance(packet, FramePacket):
+            continue
+        if packet.group_header.label != label or len(batch) >= size:
+            if batch:
+                yield label, np.array(batch, dtype=np.float32)
+            label = packet.group_header.label
+            batch = []
+        batch.append(packet.mel_powers)
+    if batch:
+        yield label, np.array(batch, dtype=np.float32)
+
 def main():
-    if len(sys.argv) != 2:
-        sys.stderr.write('USAGE: project.py [input mfcc file]\n')
+    if len(sys.argv) < 2 or len(sys.argv) > 6:
+        sys.stderr.write('USAGE: project.py [input mfcc file] [mode] [components] [samples per label] [output file]\n')
         sys.exit(1)
 
-    makeX = xmaker('pca')
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'pca'
+    comps = map(int, sys.argv[3].split(',')) if len(sys.argv) > 3 else [0,1,2]
+    size = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
+    output = sys.argv[5] if len(sys.argv) > 5 else '-'
 
-    X = []
-    L = dict()
+    makeX = batch_xmaker(mode)
+    R = dict()
 
     with oread(sys.argv[1]) as in_file:
-        for packet in MFCCReader(in_file):
-            if isinstance(packet, FramePacket):
-                label = packet.group_header.label
-                if not label in L:
-                    L[label] = []
-                L[label].append(len(X))
-                X.append(makeX(packet))
-
-    X = np.vstack(X)
-
-    #idcs = xrange(X.shape[0])
-    #if True:
-    s = min(map(len, L.itervalues()))
-    for label, idcs in L.iteritems():
-        idcs = np.random.choice(idcs, s, replace=False)
-        print '"%s"' % label
-        for i in idcs:
-            print '%f %f %f' % (X[i,0],X[i,1],X[i,2])
-        print
-        print
+        for label, mels in label_batches(MFCCReader(in_file)):
+            if not label in R:
+                R[label] = Reservoir(size, len(comps))
+            R[label].add(makeX(mels)[:, comps])
+
+    s = min([ r.seen for r in R.itervalues() ] + [size])
+    labels = sorted(R)
+
+    if output.endswith('.npy'):
+        dtype = [ ('label', 'S%d' % max(map(len, labels) + [1])), ('x', np.float32, (len(comps),)) ]
+        out = np.empty(s * len(labels), dtype=dtype)
+        for i, label in enumerate(labels):
+            out['label'][i*s:(i+1)*s] = label
+            out['x'][i*s:(i+1)*s] = R[label].sample(s)
+        np.save(output, out)
+        return
+
+    with owrite(output) as out_file:
+        fmt = ' '.join(['%f'] * len(comps)) + '\n'
+        for label in labels:
+            out_file.write('"%s"\n' % label)
+            for x in R[label].sample(s):
+                out_file.write(fmt % tuple(x))
+            out_file.write('\n\n')
 
 if __name__ == '__main__':
     main()
-
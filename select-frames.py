@@ -1,7 +1,6 @@
 #!./python
 
 import sys, itertools
-import numpy as np
 from common import *
 
 class Selector(object):
@@ -70,7 +69,9 @@ def main():
         sys.stderr.write('USAGE: select-frames.py [mode] [input mfcc file] [output mfcc file]\n')
         sys.exit(1)
 
-    makeX = xmaker(sys.argv[1])
+    # frames are picked by their own coefficients, whatever context the mode
+    # stacks around them later, so workflow can pass pre-nnet's mode as is
+    makeX = xmaker(parse_mode(sys.argv[1])[0])
 
     with oread(sys.argv[2]) as in_file:
         with owrite(sys.argv[3]) as out_file:
@@ -0,0 +1,352 @@
+#!./python
+
+import sys, os, errno, mmap, select, struct, time, atexit
+from common import *
+
+# A ring of fixed-size slots in /dev/shm, written by `mfcc --shm NAME` (or
+# ShmWriter) and read by any number of ShmReaders, each with its own cursor.
+# Every slot holds one packet as int32 packet id, int32 payload length, int32
+# sample offset and the packet without its id byte, so frame payloads are
+# float32-aligned. The header also keeps copies of the latest profile and group
+# header slots for readers that attach mid-stream. The writer never waits; a
+# reader that falls more than a ring behind skips ahead and counts the packets
+# it dropped, and since every frame carries its own sample offset, the frames
+# on both sides of the gap don't pass for neighbours.
+#
+# Readers block on a FIFO of their own in NAME.wake/ next to the ring, and the
+# writer puts a byte into every FIFO there after each packet, rescanning the
+# directory for new ones every RESCAN seconds if it changed. A FIFO nobody
+# reads from any more is removed by the writer.
+
+HEADER_FMT = '=8siiiiq'
+HEADER_SIZE = 64
+MAGIC = 'MFCCRING'
+VERSION = 2
+SLOT_HEADER_FMT = '=iii'
+SLOT_HEADER_SIZE = struct.calcsize(SLOT_HEADER_FMT)
+CURSOR_OFFSET = 24
+FINISHED_OFFSET = 20
+RESCAN = .1
+
+def ring_path(name):
+    return name if '/' in name else os.path.join('/dev/shm', name)
+
+def wake_dir(name):
+    return ring_path(name) + '.wake'
+
+class Doorbells(object):
+    def __init__(self, name):
+        self._dir = wake_dir(name)
+        self._mtime = None
+        self._scanned = 0.
+        self._fds = dict()
+        try:
+            os.mkdir(self._dir)
+        except OSError as e:
+            if errno.EEXIST != e.errno:
+                raise
+
+    def _scan(self):
+        self._mtime = os.stat(self._dir).st_mtime
+        for entry in os.listdir(self._dir):
+            if entry in self._fds:
+                continue
+            path = os.path.join(self._dir, entry)
+            try:
+                self._fds[entry] = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if errno.ENXIO == e.errno:
+                    os.unlink(path)
+
+    def ring(self):
+        # readers poll as well, so a new one can wait a moment for its first bell
+        now = time.time()
+        if now - self._scanned >= RESCAN:
+            self._scanned = now
+            if os.stat(self._dir).st_mtime != self._mtime:
+                self._scan()
+        for entry, fd in self._fds.items():
+            try:
+                os.write(fd, '\0')
+            except OSError as e:
+                if errno.EPIPE == e.errno:
+                    os.close(fd)
+                    os.unlink(os.path.join(self._dir, entry))
+                    del self._fds[entry]
+                elif errno.EAGAIN != e.errno:
+                    raise
+
+def slot_size_for(mel_filters, fft_length):
+    profile = struct.calcsize(PROFILE_HEADER_FMT) - 1 + 4 * (mel_filters+2 + fft_length)
+    frame = 4 * (mel_filters + fft_length)
+    group_header = struct.calcsize(GROUP_HEADER_FMT) - 1 + 255 + 255
+    size = SLOT_HEADER_SIZE + max(profile, frame, group_header)
+    return (size + 7) & ~7
+
+def parse_profile(data, seq):
+    _, mel_filters, fft_length, frame_length, frame_spacing, sample_rate, threshold = \
+        struct.unpack_from(PROFILE_HEADER_FMT, data)
+    x = struct.unpack_from('=%df' % (mel_filters+2 + fft_length), data, struct.calcsize(PROFILE_HEADER_FMT))
+    return ProfilePacket(
+        seq = seq,
+        frame_length = frame_length,
+        frame_spacing = frame_spacing,
+        sample_rate = sample_rate,
+        mel_power_threshold = threshold,
+        mel_filters = mel_filters,
+        fft_length = fft_length,
+        mel_freqs = x[:mel_filters+2],
+        fft_freqs = x[mel_filters+2:])
+
+class ShmWriter(object):
+    def __init__(self, name, slot_size, capacity=16384):
+        self.slot_size = slot_size
+        self.capacity = capacity
+        self._slots_offset = HEADER_SIZE + 2 * slot_size
+        self._cursor = 0
+        self._frame_spacing = 0
+        self._sample_offset = 0
+        self._doorbells = Doorbells(name)
+
+        path = ring_path(name)
+        if os.path.exists(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+        size = self._slots_offset + capacity * slot_size
+        os.ftruncate(fd, size)
+        self._map = mmap.mmap(fd, size)
+        os.close(fd)
+
+        self._floats = np.frombuffer(self._map, dtype=np.float32, offset=self._slots_offset,
+                                     count=capacity * slot_size // 4).reshape((capacity, slot_size // 4))
+        # magic goes last, readers wait for it
+        struct.pack_into(HEADER_FMT, self._map, 0, '', VERSION, slot_size, capacity, 0, 0)
+        self._map[0:len(MAGIC)] = MAGIC
+
+    def _publish(self):
+        self._cursor += 1
+        struct.pack_into('=q', self._map, CURSOR_OFFSET, self._cursor)
+        self._doorbells.ring()
+
+    def _put(self, offset, packet_id, payload, sample_offset):
+        if SLOT_HEADER_SIZE + len(payload) > self.slot_size:
+            raise ValueError('packet of %d bytes does not fit %d byte slots' % (len(payload), self.slot_size))
+        struct.pack_into(SLOT_HEADER_FMT, self._map, offset, packet_id, len(payload), sample_offset)
+        self._map[offset+SLOT_HEADER_SIZE : offset+SLOT_HEADER_SIZE+len(payload)] = payload
+
+    def write_raw(self, data):
+        # frames have no offset of their own in the stream, they follow
+        # their group header one frame spacing apart
+        packet_id = ord(data[0])
+        if PROFILE_PACKET_ID == packet_id:
+            self._frame_spacing = parse_profile(data, 0).frame_spacing
+            self._put(HEADER_SIZE, packet_id, data[1:], 0)
+        if GROUP_HEADER_PACKET_ID == packet_id:
+            self._sample_offset = parse_group_header(data)[2]
+            self._put(HEADER_SIZE + self.slot_size, packet_id, data[1:], self._sample_offset)
+        self._put(self._slots_offset + self._cursor % self.capacity * self.slot_size, packet_id, data[1:],
+                  self._sample_offset)
+        if FRAME_PACKET_ID == packet_id:
+            self._sample_offset += self._frame_spacing
+        self._publish()
+
+    def write_frame(self, x):
+        i = self._cursor % self.capacity
+        struct.pack_into(SLOT_HEADER_FMT, self._map, self._slots_offset + i * self.slot_size,
+                         FRAME_PACKET_ID, 4 * len(x), self._sample_offset)
+        self._floats[i, SLOT_HEADER_SIZE//4 : SLOT_HEADER_SIZE//4 + len(x)] = x
+        self._sample_offset += self._frame_spacing
+        self._publish()
+
+    def finish(self):
+        struct.pack_into('=i', self._map, FINISHED_OFFSET, 1)
+        self._doorbells.ring()
+
+class ShmReader(object):
+    # frames are views into the ring unless copy is set, and stay valid only
+    # until the writer laps them; a reader starts at the newest packet, but
+    # from the beginning if it was waiting for the ring to appear or with
+    # from_start, as long as the ring has not wrapped yet
+    def __init__(self, name, copy=False, from_start=False, poll=.05):
+        self.seekable = False
+        self.dropped = 0
+        self._copy = copy
+        self._poll = poll
+        self._bell = None
+
+        path = ring_path(name)
+        waited = False
+        while True:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                waited = True
+                time.sleep(.005)
+                continue
+            if os.fstat(fd).st_size > HEADER_SIZE:
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                if self._map[:len(MAGIC)] == MAGIC:
+                    os.close(fd)
+                    break
+            os.close(fd)
+            waited = True
+            time.sleep(.005)
+
+        _, version, self.slot_size, self.capacity, _, self.cursor = \
+            struct.unpack_from(HEADER_FMT, self._map, 0)
+        if version != VERSION:
+            raise ValueError('%s is a version %d frame ring, expected %d' % (path, version, VERSION))
+        if (from_start or waited) and self.cursor < self.capacity:
+            self.cursor = 0
+
+        self._bell_path = os.path.join(wake_dir(name), '%d-%x' % (os.getpid(), id(self)))
+        os.mkfifo(self._bell_path, 0600)
+        self._bell = os.open(self._bell_path, os.O_RDONLY | os.O_NONBLOCK)
+        atexit.register(self.close)
+
+        self._slots_offset = HEADER_SIZE + 2 * self.slot_size
+        self._floats = np.frombuffer(self._map, dtype=np.float32, offset=self._slots_offset,
+                                     count=self.capacity * self.slot_size // 4).reshape((self.capacity, self.slot_size // 4))
+
+        self.current_profile = None
+        self.current_group_header = None
+        self._profile_seq = 0
+        self._group_header_seq = 0
+        self._frame_seq = 0
+
+        # readers start at the write cursor, so hand out the latest profile
+        # and group header first
+        self._pending = []
+        if self.cursor > 0:
+            for offset in (HEADER_SIZE, HEADER_SIZE + self.slot_size):
+                packet_id, _, _ = struct.unpack_from(SLOT_HEADER_FMT, self._map, offset)
+                if packet_id:
+                    self._pending.append(self._decode(offset, packet_id, None))
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        if self._bell is not None:
+            os.close(self._bell)
+            os.unlink(self._bell_path)
+            self._bell = None
+
+    def _wait(self):
+        if select.select([self._bell], [], [], self._poll)[0]:
+            try:
+                os.read(self._bell, 4096)
+            except OSError as e:
+                if errno.EAGAIN != e.errno:
+                    raise
+
+    def _write_cursor(self):
+        return struct.unpack_from('=q', self._map, CURSOR_OFFSET)[0]
+
+    def buffered(self):
+        return len(self._pending) + self._write_cursor() - self.cursor
+
+    def fill(self):
+        # the writer fills the ring, there is nothing to read; only frames
+        # still to come are worth waiting for
+        return not self.finished() or self.frame_buffered()
+
+    def frame_buffered(self):
+        if any( isinstance(packet, FramePacket) for packet in self._pending ):
+            return True
+        for cursor in xrange(max(self.cursor, self._write_cursor() - self.capacity + 1), self._write_cursor()):
+            offset = self._slots_offset + cursor % self.capacity * self.slot_size
+            if FRAME_PACKET_ID == struct.unpack_from('=i', self._map, offset)[0]:
+                return True
+        return False
+
+    def finished(self):
+        return 1 == struct.unpack_from('=i', self._map, FINISHED_OFFSET)[0]
+
+    def _decode(self, offset, packet_id, index):
+        _, length, sample_offset = struct.unpack_from(SLOT_HEADER_FMT, self._map, offset)
+
+        if FRAME_PACKET_ID == packet_id:
+            profile = self.current_profile
+            x = self._floats[index, SLOT_HEADER_SIZE//4 : SLOT_HEADER_SIZE//4 + length // 4]
+            if self._copy:
+                x = x.copy()
+            self._frame_seq += 1
+            frame = FramePacket(
+                seq = self._frame_seq,
+                group_header = self.current_group_header,
+                mel_powers = x[:profile.mel_filters],
+                fft_powers = x[profile.mel_filters:],
+                sample_offset = sample_offset)
+            return frame
+
+        data = chr(packet_id) + self._map[offset+SLOT_HEADER_SIZE : offset+SLOT_HEADER_SIZE+length]
+
+        if PROFILE_PACKET_ID == packet_id:
+            self._profile_seq += 1
+            self.current_profile = parse_profile(data, self._profile_seq)
+            return self.current_profile
+
+        if GROUP_HEADER_PACKET_ID == packet_id:
+            filename, label, sample_offset = parse_group_header(data)
+            self._group_header_seq += 1
+            self.current_group_header = GroupHeaderPacket(
+                seq = self._group_header_seq,
+                profile = self.current_profile,
+                filename = filename,
+                label = label,
+                sample_offset = sample_offset)
+            return self.current_group_header
+
+        raise Exception('unrecognized packet id %d' % packet_id)
+
+    def next(self):
+        if self._pending:
+            return self._pending.pop(0)
+
+        while True:
+            written = self._write_cursor()
+            if self.cursor >= written:
+                if self.finished():
+                    raise StopIteration
+                self._wait()
+                continue
+
+            # the slot after the newest may be half overwritten already
+            if written - self.cursor >= self.capacity:
+                skip = written - self.capacity + 1 - self.cursor
+                self.dropped += skip
+                self.cursor += skip
+
+            index = self.cursor % self.capacity
+            offset = self._slots_offset + index * self.slot_size
+            packet_id, _, _ = struct.unpack_from(SLOT_HEADER_FMT, self._map, offset)
+            packet = self._decode(offset, packet_id, index)
+            self.cursor += 1
+
+            # views can't be protected against the writer anyway
+            if not self._copy and FRAME_PACKET_ID == packet_id:
+                return packet
+            if self._write_cursor() - (self.cursor-1) < self.capacity:
+                return packet
+            self.dropped += 1
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write('USAGE: shmring.py [ring name] [output mfcc file]\n')
+        sys.exit(1)
+
+    reader = ShmReader(sys.argv[1], from_start=True)
+    with owrite(sys.argv[2]) as out_file:
+        writer = MFCCWriter(out_file)
+        for packet in reader:
+            writer.write(packet)
+            if not reader.buffered():
+                out_file.flush()
+
+    reader.close()
+    if reader.dropped:
+        sys.stderr.write('dropped %d packets\n' % reader.dropped)
+
+if __name__ == '__main__':
+    main()
@@ -22,15 +22,15 @@ class PoorPlotter(gtk.DrawingArea):
 
         self._width = self._height = 1
 
-        self._mel_data = ()
-        self._freq_data = ()
+        self._mean_data = ()
+        self._bands = ()
         self._label = None
 
-    def set_data(self, mel_data=None, freq_data=None, label=None):
-        if mel_data is not None:
-            self._mel_data = mel_data
-        if freq_data is not None:
-            self._freq_data = freq_data
+    def set_data(self, mean_data=None, bands=None, label=None):
+        if mean_data is not None:
+            self._mean_data = mean_data
+        if bands is not None:
+            self._bands = bands
         if label is not None:
             self._label = label
 
@@ -116,32 +116,70 @@ class PoorPlotter(gtk.DrawingArea):
                 else:
                     cr.line_to(px,py)
 
-        cr.set_source_rgba(0., 0., 0., .02)
-        for x in self._mel_data:
-            plot_line(x)
-            cr.stroke()
+        cr.set_source_rgba(0., 0., 0., .15)
+        for lower, upper in self._bands:
+            plot_line(lower)
+            for x,y in reversed(upper):
+                cr.line_to(*self.pt2xy((x,y)))
+            cr.close_path()
+            cr.fill()
 
-def main():
-    if len(sys.argv) != 3:
-        sys.stderr.write('USAGE: vis-mean.py [input mfcc file] [label]\n')
-        sys.exit(1)
+        cr.set_source_rgb(0., 0., 0.)
+        cr.set_line_width(2.)
+        plot_line(self._mean_data)
+        cr.stroke()
 
+def aggregate(reader, label):
+    profiles = []
+    histograms = None
+
+    # bands of different filterbanks don't add up
+    def frames():
+        for packet in reader:
+            if isinstance(packet, FramePacket) and packet.group_header.label == label:
+                profile = packet.group_header.profile
+                if not profiles:
+                    profiles.append(profile)
+                elif tuple(profile.mel_freqs) != tuple(profiles[0].mel_freqs) or \
+                     profile.mel_power_threshold != profiles[0].mel_power_threshold:
+                    raise ValueError('frames of label %s come with different profiles' % label)
+                yield packet
+
+    for mels in frame_batches(frames()):
+        if histograms is None:
+            threshold = profiles[0].mel_power_threshold
+            histograms = Histograms(profiles[0].mel_filters, threshold, threshold + 100., 500)
+        histograms.add(mels)
+
+    return profiles[0] if profiles else None, histograms
 
-    in_file = open(sys.argv[1], 'rb') if sys.argv[1] != '-' else sys.stdin
-    reader = MFCCReader(in_file)
+def main():
+    if len(sys.argv) not in (3,4):
+        sys.stderr.write('USAGE: vis-mean.py [input mfcc file] [label] [gnuplot output file]\n')
+        sys.exit(1)
 
     label = sys.argv[2]
 
-    profiles, _, frames = reader.read_all()
-    profile = profiles[0]
+    with oread(sys.argv[1]) as in_file:
+        profile, histograms = aggregate(MFCCReader(in_file), label)
+    if histograms is None:
+        sys.stderr.write('no frames with label %s\n' % label)
+        sys.exit(1)
+
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as f:
+            titles = [ '%s-mel-%d' % (label, i) for i in xrange(profile.mel_filters) ]
+            write_histograms(f, titles, histograms)
+        return
 
-    mel_data = [ zip(profile.mel_freqs[1:], f.mel_powers)
-                for f in frames if f.group_header.label == label ]
-    step = int(len(mel_data) / 2000)
-    mel_data = mel_data[::step]
+    freqs = profile.mel_freqs[1:-1]
+    P = histograms.percentiles((5, 25, 75, 95))
+    bands = [ (zip(freqs, P[0]), zip(freqs, P[3])),
+              (zip(freqs, P[1]), zip(freqs, P[2])) ]
 
     vis = PoorPlotter()
-    vis.set_data(mel_data = mel_data, label = "mean for label " + label)
+    vis.set_data(mean_data = zip(freqs, histograms.mean()), bands = bands,
+                 label = 'mean and 5/25/75/95 percentiles for label %s (%d frames)' % (label, histograms.n))
 
     window = gtk.Window()
     window.connect("delete-event", gtk.main_quit)
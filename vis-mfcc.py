@@ -137,26 +137,26 @@ class MFCCBrowser(object):
         self._reader = reader
         self.push_data = True
 
-    def forward(self):
+    def pull(self):
         try:
-            while True:
-                packet = next(self._reader)
-                if isinstance(packet, FramePacket):
-                    break
+            frame = self._reader.pull()
         except StopIteration:
             return False
 
-        self.push_to_vis(packet)
+        if frame is not None and self.push_data:
+            self.push_to_vis(self._reader.seek_latest())
         return True
 
-    def backward(self):
-        self.push_to_vis(self._reader.seek(-1))
-        return True
+    def show(self):
+        self.push_to_vis(self._reader.get_current_frame())
 
-    def push_to_vis(self, frame):
-        if not self.push_data:
-            return
+    def move(self, offs):
+        self.push_to_vis(self._reader.seek(offs))
+
+    def move_group(self, offs):
+        self.push_to_vis(self._reader.seek_group(offs))
 
+    def push_to_vis(self, frame):
         group_header = frame.group_header
         profile = group_header.profile
 
@@ -171,26 +171,40 @@ class MFCCBrowser(object):
 def main():
     vis = PoorPlotter()
 
-    reader = MFCCReader(sys.stdin)
-    if reader.seekable:
-        reader = SeekableMFCCReader(reader)
-
-    browser = MFCCBrowser(reader, vis)
-
-    if not reader.seekable:
-        glib.io_add_watch(sys.stdin, glib.IO_IN, lambda source,condition: browser.forward())
+    if len(sys.argv) > 1 and sys.argv[1].startswith('shm:'):
+        from shmring import ShmReader
+        ring = ShmReader(sys.argv[1][4:], copy=True)
+        reader = SeekableMFCCReader(ring)
+        browser = MFCCBrowser(reader, vis)
+        glib.timeout_add(5, lambda: not ring.buffered() or browser.pull())
     else:
-        browser.forward()
+        reader = SeekableMFCCReader(MFCCReader(sys.stdin))
+        browser = MFCCBrowser(reader, vis)
 
-    def keypress(widget, event):
-        if not reader.seekable:
-            if event.keyval == gtk.keysyms.space:
-                browser.push_data = not browser.push_data
+        if reader.streaming:
+            glib.io_add_watch(sys.stdin, glib.IO_IN, lambda source,condition: browser.pull())
         else:
-            if event.keyval == gtk.keysyms.Left:
-                browser.backward()
-            elif event.keyval == gtk.keysyms.Right:
-                browser.forward()
+            browser.show()
+
+    def keypress(widget, event):
+        if reader.streaming and event.keyval == gtk.keysyms.space:
+            browser.push_data = not browser.push_data
+            return
+        if reader.streaming and browser.push_data:
+            return
+
+        if event.keyval == gtk.keysyms.Left:
+            browser.move(-1)
+        elif event.keyval == gtk.keysyms.Right:
+            browser.move(1)
+        elif event.keyval == gtk.keysyms.Page_Up:
+            browser.move(-100)
+        elif event.keyval == gtk.keysyms.Page_Down:
+            browser.move(100)
+        elif event.keyval == gtk.keysyms.Up:
+            browser.move_group(-1)
+        elif event.keyval == gtk.keysyms.Down:
+            browser.move_group(1)
 
     window = gtk.Window()
     window.connect("delete-event", gtk.main_quit)
@@ -0,0 +1,220 @@
+#!./python
+
+import sys, os, re, getopt, hashlib, json, subprocess, threading, collections
+
+STATE_FILE = '.workflow.state'
+
+# the speaker and sound selections of extract-male-voiced.sh
+TRAINING_SET = '^(jp1m1|sw1m1|kd1m1|mr1m1|sg1m1|sg2m1|jc1m1|wm1m1|bc1m1|ms1m1|js1m1|ao1m1|rg1m1|jo1m1|dg1m1|zb1m1|kd2m1|zk1m1|ts1m1|ps1m1|sp1m1|tz1m1)'
+TEST_SET = '^(jk1m1|wb1m1|jp2m1|pl1m1|pw1m1)'
+SOUNDS = '^[aeilnouy]$'
+
+Stage = collections.namedtuple('Stage', ('name', 'command', 'inputs', 'outputs', 'params', 'stdout'))
+
+def script(name, *args):
+    return [sys.executable, os.path.join('.', name)] + list(args)
+
+# a script and every module of ours it may import, also lazily inside
+# functions or through common.LazyModule, so editing any of them reruns it
+IMPORT_RE = re.compile(r'^\s*(?:from\s+(\w+)\s+import|import\s+([\w, ]+))|LazyModule\(\'(\w+)\'\)', re.M)
+def sources(name, seen=None):
+    seen = [] if seen is None else seen
+    seen.append(name)
+    with open(name) as f:
+        text = f.read()
+    for m in IMPORT_RE.finditer(text):
+        for module in (m.group(1) or m.group(2) or m.group(3)).split(','):
+            filename = module.strip() + '.py'
+            if filename not in seen and os.path.exists(filename):
+                sources(filename, seen)
+    return seen
+
+def pipeline(corpus, modes, seed, training_set, test_set, sounds, augment):
+    stages = []
+    def stage(name, command, inputs, outputs, stdout=None, **params):
+        stages.append(Stage(name, command, inputs, outputs, params, stdout))
+
+    sets = dict(training = training_set, test = test_set)
+    for name, regexp in sorted(sets.iteritems()):
+        stage('extract-%s' % name,
+              script('extract-sounds.py', regexp, sounds, corpus, 'mfccs/%s.mfcc' % name),
+              [corpus] + sources('extract-sounds.py'), ['mfccs/%s.mfcc' % name])
+
+    for mode in modes:
+        for name in sorted(sets):
+            selected = 'mfccs/%s-%s.mfcc' % (name, mode)
+            dataset = 'datasets/%s-%s.pkl' % (name, mode)
+            stage('select-%s-%s' % (name, mode),
+                  script('select-frames.py', mode, 'mfccs/%s.mfcc' % name, selected),
+                  ['mfccs/%s.mfcc' % name] + sources('select-frames.py'), [selected])
+            stage('pre-nnet-%s-%s' % (name, mode),
+                  script('pre-nnet.py', mode, dataset, selected),
+                  [selected] + sources('pre-nnet.py'), [dataset], seed = seed)
+
+        # not nnets/, which holds the tracked reference weights
+        weights = 'weights/%s.pkl' % mode
+        stage('learn-%s' % mode,
+              script('nnet.py', 'learn', '-a', augment, 'datasets/training-%s.pkl' % mode, weights),
+              ['datasets/training-%s.pkl' % mode] + sources('nnet.py'), [weights], seed = seed)
+        stage('test-%s' % mode,
+              script('nnet.py', 'test', 'datasets/test-%s.pkl' % mode, weights),
+              ['datasets/test-%s.pkl' % mode, weights] + sources('nnet.py'),
+              ['results/%s.txt' % mode], stdout = 'results/%s.txt' % mode)
+
+    return stages
+
+class Hasher(object):
+    def __init__(self, cache):
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    def __call__(self, filename):
+        if not os.path.exists(filename):
+            return None
+        st = os.stat(filename)
+        stamp = [st.st_size, st.st_mtime]
+        with self._lock:
+            if filename in self._cache and self._cache[filename][:2] == stamp:
+                return self._cache[filename][2]
+
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+
+        with self._lock:
+            self._cache[filename] = stamp + [h.hexdigest()]
+        return h.hexdigest()
+
+def fingerprint(stage, hasher):
+    h = hashlib.sha1()
+    h.update(json.dumps([stage.command[1:], sorted(stage.params.items())]))
+    for filename in stage.inputs:
+        h.update('%s=%s\n' % (filename, hasher(filename)))
+    return h.hexdigest()
+
+def run_stage(stage):
+    for filename in stage.outputs:
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    env = dict(os.environ)
+    if stage.params.get('seed') is not None:
+        env['NNETS_SEED'] = str(stage.params['seed'])
+
+    log = open(stage.stdout, 'wb') if stage.stdout else open(os.devnull, 'wb')
+    with log:
+        return subprocess.call(stage.command, stdout=log, env=env)
+
+def execute(stages, state, jobs, dry_run):
+    hasher = Hasher(state.setdefault('hashes', dict()))
+    done = state.setdefault('stages', dict())
+
+    producer = dict( (out, s.name) for s in stages for out in s.outputs )
+    deps = dict( (s.name, set(producer[x] for x in s.inputs if x in producer)) for s in stages )
+    by_name = dict( (s.name, s) for s in stages )
+
+    finished = set()
+    stale = set()
+    failed = set()
+    running = set()
+    cond = threading.Condition()
+
+    def ready():
+        return [ s for s in stages
+                 if s.name not in finished and s.name not in running and s.name not in failed
+                    and deps[s.name] <= finished ]
+
+    def worker(stage):
+        fp = fingerprint(stage, hasher)
+        fresh = done.get(stage.name) == fp and all(os.path.exists(x) for x in stage.outputs) \
+                and not deps[stage.name] & stale
+        if fresh:
+            rc = 0
+        elif dry_run:
+            print 'would run %s' % stage.name
+            stale.add(stage.name)
+            rc = 0
+        else:
+            print 'running %s' % stage.name
+            sys.stdout.flush()
+            rc = run_stage(stage)
+
+        with cond:
+            running.discard(stage.name)
+            if 0 == rc:
+                if not fresh and not dry_run:
+                    done[stage.name] = fp
+                finished.add(stage.name)
+            else:
+                print '%s failed with exit code %d' % (stage.name, rc)
+                failed.add(stage.name)
+            cond.notify_all()
+
+    with cond:
+        while True:
+            for stage in ready():
+                if len(running) >= jobs:
+                    break
+                running.add(stage.name)
+                t = threading.Thread(target=worker, args=(stage,))
+                t.daemon = True
+                t.start()
+            if not running:
+                break
+            cond.wait(1.)
+
+    blocked = [ name for name in by_name if name not in finished and name not in failed ]
+    for name in blocked:
+        print 'skipped %s' % name
+    return not failed and not blocked
+
+def main():
+    try:
+        opts, targets = getopt.getopt(sys.argv[1:], 'j:n',
+            ['corpus=', 'modes=', 'seed=', 'training-set=', 'test-set=', 'sounds=', 'augment='])
+    except getopt.GetoptError:
+        sys.stderr.write('USAGE: workflow.py [-j jobs] [-n] [--corpus file] [--modes pca,dcts,...] [--seed n]\n'
+                         '                   [--training-set regexp] [--test-set regexp] [--sounds regexp]\n'
+                         '                   [--augment silence=1,noise=0,gain=0,copies=1] [stage...]\n')
+        sys.exit(1)
+    opts = dict(opts)
+
+    stages = pipeline(
+        corpus = opts.get('--corpus', 'mfccs/corpora.mfcc'),
+        modes = opts.get('--modes', 'pca,dcts').split(','),
+        seed = int(opts['--seed']) if '--seed' in opts else None,
+        training_set = opts.get('--training-set', TRAINING_SET),
+        test_set = opts.get('--test-set', TEST_SET),
+        sounds = opts.get('--sounds', SOUNDS),
+        augment = opts.get('--augment', 'silence=1'))
+
+    if targets:
+        # a target pulls in everything it depends on
+        producer = dict( (out, s) for s in stages for out in s.outputs )
+        wanted = set()
+        todo = [ s for s in stages if s.name in targets ]
+        while todo:
+            s = todo.pop()
+            if s.name not in wanted:
+                wanted.add(s.name)
+                todo.extend(producer[x] for x in s.inputs if x in producer)
+        stages = [ s for s in stages if s.name in wanted ]
+
+    try:
+        with open(STATE_FILE, 'r') as f:
+            state = json.load(f)
+    except IOError:
+        state = dict()
+
+    try:
+        ok = execute(stages, state, int(opts.get('-j', 2)), '-n' in opts)
+    finally:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()